@@ -1,17 +1,36 @@
 import peewee
 from playhouse import db_url
 from playhouse.shortcuts import RetryOperationalError
+from playhouse.pool import PooledDatabase
 
 import eve
-from eve.utils import config, auto_fields, str_to_date
+from eve.utils import config, auto_fields, str_to_date, parse_request, \
+    document_etag, ParsedRequest, weak_date, date_to_rfc1123
 from eve.io.base import DataLayer, BaseJSONEncoder
+from eve.auth import requires_auth, resource_auth, auth_field_and_value
+from eve.methods.common import resolve_embedded_fields, get_document
+from eve.methods.post import post_internal
+from eve.methods.patch import patch_internal
+from eve.methods.put import put_internal
+from eve.methods.delete import deleteitem_internal
+from eve.render import send_response
 from werkzeug.exceptions import HTTPException, abort
+from werkzeug.urls import url_encode
 from cerberus import Validator
+from flask import request, current_app, Response, stream_with_context, \
+    g, has_app_context, has_request_context
 
+from .cache import LRUCache
+from .fields import JSONTextField, MsgpackField, LazyJSON
+from .schema import provision_indexes, plan_indexes
+from .migrate import plan_migration, apply_migration, check_migration, \
+    schema_fingerprint, synchronize_schema, add_missing_columns
+
+from collections import deque, OrderedDict
 from datetime import datetime
 from functools import reduce
-import time, json, operator
-import traceback, sys
+import time, json, operator, base64, copy, hashlib
+import traceback, sys, threading, uuid, re
 
 __version__ = '0.0.6'
 
@@ -23,71 +42,475 @@ class BaseModel(peewee.Model):
     _created = peewee.DateTimeField()
     _updated = peewee.DateTimeField()
     _deleted = peewee.BooleanField(null=False, default=False)
+    # eve stores the etag it computed on write and compares If-Match to it
+    _etag = peewee.CharField(null=True)
 
     def __contains__(self, key):
         return key in self._data
 
+    @classmethod
+    def select(cls, *selection):
+        query = super(BaseModel, cls).select(*selection)
+        # Meta.read_database picks the database reads go to (replicas)
+        read_database = getattr(cls._meta, 'read_database', None)
+        if read_database is not None:
+            query.database = read_database()
+        return query
+
 
 class PeeweeJSONEncoder(BaseJSONEncoder):
     def default(self, obj):
         if isinstance(obj, BaseModel):
             return str(obj)
+        elif isinstance(obj, LazyJSON):
+            return obj.value
         else:
             return super(PeeweeJSONEncoder, self).default(obj)
 
 
+class PooledRetryOperationalError(object):
+    """RetryOperationalError for connection pools: the connection that
+    failed is closed instead of going back to the pool for reuse
+    """
+    def execute_sql(self, sql, params=None, require_commit=True):
+        try:
+            cursor = super(PooledRetryOperationalError, self).execute_sql(
+                sql, params, require_commit)
+        except peewee.OperationalError:
+            if not self.is_closed():
+                self.manual_close()
+            with self.exception_wrapper:
+                cursor = self.get_cursor()
+                cursor.execute(sql, params or ())
+                if require_commit and self.get_autocommit():
+                    self.commit()
+        return cursor
+
+
+def _drop_null_etag(doc):
+    """Rows written outside eve have no etag, eve computes one for
+    documents without the key
+    """
+    if doc.get('_etag', '') is None:
+        del doc['_etag']
+    return doc
+
+
+def _decode_json(doc):
+    """Decodes the LazyJSON values of doc, eve only knows plain dicts and
+    lists outside of the JSON encoder (XML rendering, validation, merges)
+    """
+    for key, value in doc.items():
+        if isinstance(value, LazyJSON):
+            doc[key] = value.value
+    return doc
+
+
 class EvePeeweeResultIterator(object):
+    """Yields row dicts straight from the cursor, rows aren't kept around
+    once they've been handed out
+    """
     def __init__(self, qrw):
         self.qrw = qrw
-        self._idx = 0
 
     def next(self):
-        if self._idx < self.qrw._ct:
-            obj = self.qrw._result_cache[self._idx]
-        elif not self.qrw._populated:
-            obj = self.qrw.iterate()
-            self.qrw._result_cache.append(obj)
-            self.qrw._ct += 1
-        else:
+        qrw = self.qrw
+        if qrw._prefetch is not None:
+            if not qrw._ready:
+                # related rows are loaded for a batch of rows at once
+                batch = list(qrw.read_ahead(qrw._batch_size))
+                qrw._buffer.clear()
+                qrw._prefetch(batch)
+                qrw._ready.extend(batch)
+            if qrw._ready:
+                row = qrw._ready.popleft()
+            else:
+                if qrw._server_side:
+                    qrw.cursor.close()
+                raise StopIteration
+        elif qrw._buffer:
+            row = qrw._buffer.popleft()
+        elif qrw._populated:
             raise StopIteration
-        self._idx += 1
-        return obj._data
+        else:
+            try:
+                row = qrw.iterate()
+            except StopIteration:
+                if qrw._server_side:
+                    qrw.cursor.close()
+                raise
+        for key in qrw._hidden:
+            row.pop(key, None)
+        return _decode_json(_drop_null_etag(row))
     __next__ = next
 
 
-class EvePeeweeResultWrapper(peewee.NaiveQueryResultWrapper):
+def _count_strategy_extra(strategy, response):
+    if not strategy:
+        return
+    if has_request_context():
+        # eve's xml renderer takes every _meta value for a number, the
+        # strategy goes out as a header, see EvePeewee._count_strategy_header
+        g._eve_peewee_count_strategy = strategy
+    if strategy == 'has_more' and isinstance(response, dict) and \
+            config.LINKS in response:
+        # total is only a lower bound
+        response[config.LINKS].pop('last', None)
+
+
+class EvePeeweeResultWrapper(peewee.DictQueryResultWrapper):
+    @classmethod
+    def adopt(cls, qrw, server_side=False, hidden=(), prefetch=None,
+              batch_size=None):
+        """Takes over the result wrapper of an executed dicts() query.
+        prefetch is called with each batch of batch_size rows before they're
+        handed out.
+        """
+        qrw.__class__ = cls
+        # rows read ahead of iteration, e.g. while counting
+        qrw._buffer = deque()
+        qrw._server_side = server_side
+        # extra columns that aren't part of the documents
+        qrw._hidden = hidden
+        qrw._prefetch = prefetch
+        qrw._batch_size = batch_size
+        # prefetched rows
+        qrw._ready = deque()
+        return qrw
+
     def count(self, **kwargs):
         if hasattr(self, '_count'):
             return self._count
         else:
             return super(EvePeeweeResultWrapper, self).count
 
+    def read_ahead(self, n):
+        """Fetches rows until n are buffered or the cursor is exhausted"""
+        while len(self._buffer) < n and not self._populated:
+            try:
+                self._buffer.append(self.iterate())
+            except StopIteration:
+                break
+        return self._buffer
+
     def __iter__(self):
-        if self._populated:
-            return iter(self._result_cache)
-        else:
-            return EvePeeweeResultIterator(self)
+        return EvePeeweeResultIterator(self)
+
+    def extra(self, response):
+        _count_strategy_extra(getattr(self, '_count_strategy', None), response)
+
+
+class EvePeeweeListResult(object):
+    """Cursor over an already fetched page of documents.
+    links and meta are merged into the response through Eve's `extra` hook.
+    """
+    def __init__(self, documents, count, links=None, meta=None,
+                 count_strategy=None):
+        self.documents = documents
+        self._count = count
+        self.links = links
+        self.meta = meta
+        self._count_strategy = count_strategy
+
+    def count(self, **kwargs):
+        return self._count
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def extra(self, response):
+        if not isinstance(response, dict):
+            return
+        _count_strategy_extra(self._count_strategy, response)
+        if self.meta and config.META in response:
+            response[config.META].update(self.meta)
+        if self.links is not None and config.LINKS in response:
+            links = response[config.LINKS]
+            for rel in ('next', 'prev', 'last'):
+                links.pop(rel, None)
+            links.update(self.links)
+
+
+# stands in for the id in prepared by-id selects
+_ID_PARAM = object()
+
+
+# value stand-in while resolving where keys for query plans
+_WHERE_PARAM = object()
+
+
+class QueryPlan(object):
+    """Value independent part of a find query: selected fields, where terms
+    as (key, field, operator) and the sort as (field, ascending) pairs.
+    bind() turns it into a query for a where dict of the same shape.
+    """
+    __slots__ = ('fields', 'terms', 'joins', 'sort')
+
+    # terms are (key, field, operator, build), build taking the value and
+    # returning the expression when it isn't a plain comparison
+
+    def __init__(self, fields, terms, joins, sort):
+        self.fields = fields
+        self.terms = terms
+        self.joins = joins
+        self.sort = sort
+
+    def bind(self, model, spec):
+        op = model.select(*self.fields)
+        if self.terms:
+            where = reduce(operator.and_, [
+                build(spec[key]) if build else
+                peewee.Expression(lhs, op_, spec[key])
+                for key, lhs, op_, build in self.terms])
+            # joined lookups need filter() to add the joins
+            op = op.filter(where) if self.joins else op.where(where)
+        if self.sort:
+            op = op.order_by(*[f if asc else f.desc() for f, asc in self.sort])
+        return op
+
+
+def _data_relation(fs):
+    """data_relation of a field schema, for lists it can be given on the
+    field or on its items like eve expects it
+    """
+    rel = fs.get('data_relation')
+    if not rel and fs.get('type') == 'list':
+        rel = (fs.get('schema') or {}).get('data_relation')
+    return rel or None
+
+
+_JSON_KEY = re.compile(r'^\w+$')
+
+#: comparisons of values in JSON fields, by where key suffix
+json_operators = {
+    'eq': operator.eq, 'ne': operator.ne,
+    'lt': operator.lt, 'lte': operator.le,
+    'gt': operator.gt, 'gte': operator.ge,
+}
+
+
+#: where keys taking a list of where documents
+where_combinators = ('$and', '$or', '$nor')
+
+
+def _is_operator_dict(value):
+    """Whether a where value is {$op: argument, ...}"""
+    return isinstance(value, dict) and bool(value) and \
+        all(k.startswith('$') for k in value)
+
+
+def _is_boolean_key(key, value):
+    """Where keys compiled by EvePeewee._where_expression rather than
+    peewee's convert_dict_to_node
+    """
+    return key.startswith('$') or _is_operator_dict(value)
+
+
+def _json_base(key):
+    """Field name of a where key like 'features.rooms__gt'"""
+    return re.split(r'\.|__', key, 1)[0]
+
+
+def _json_key(key):
+    if not _JSON_KEY.match(str(key)):
+        abort(400, description='Invalid JSON key: %s' % (key,))
+    return str(key)
+
+
+def _jsonb(value):
+    return peewee.Clause(peewee.Param(json.dumps(value)), peewee.SQL('::jsonb'))
+
+
+def _json_path(path):
+    """JSON1 path of a list of keys, digits index arrays"""
+    return '$' + ''.join('[%s]' % p if p.isdigit() else '.' + p for p in path)
+
+
+def _pg_json_term(field, path, op):
+    node = field
+    if path:
+        node = peewee.EnclosedClause(
+            peewee.Clause(field, peewee.SQL('#>'), peewee.Param(path)))
+    if op == 'contains':
+        return lambda value: peewee.Clause(node, peewee.SQL('@>'), _jsonb(value))
+    if op == 'has_key':
+        return lambda value: peewee.Clause(node, peewee.SQL('?'),
+                                           peewee.Param(_json_key(value)))
+    compare = json_operators[op]
+    return lambda value: compare(node, _jsonb(value))
+
+
+def _sqlite_contains(field, path, value):
+    """Containment as json_extract comparisons of the leaves of value,
+    list items are looked up with json_each
+    """
+    if isinstance(value, dict):
+        terms = [_sqlite_contains(field, path + [_json_key(k)], v)
+                 for k, v in value.items()]
+    elif isinstance(value, list):
+        terms = []
+        for item in value:
+            if isinstance(item, (dict, list)):
+                abort(400, description='Nested documents in list containment '
+                      'filters need postgres')
+            terms.append(peewee.Clause(
+                peewee.SQL('EXISTS (SELECT 1 FROM json_each('), field,
+                peewee.SQL(','), peewee.Param(_json_path(path)),
+                peewee.SQL(') WHERE value ='), peewee.Param(item),
+                peewee.SQL(')')))
+    else:
+        return peewee.fn.json_extract(field, _json_path(path)) == value
+    if not terms:
+        return peewee.SQL('1 = 1')
+    return reduce(operator.and_, terms)
+
+
+def _sqlite_json_term(field, path, op):
+    if op == 'contains':
+        return lambda value: _sqlite_contains(field, path, value)
+    if op == 'has_key':
+        return lambda value: peewee.Expression(
+            peewee.fn.json_type(field, _json_path(path + [_json_key(value)])),
+            peewee.OP.IS_NOT, None)
+    compare = json_operators[op]
+    return lambda value: compare(
+        peewee.fn.json_extract(field, _json_path(path)), value)
+
+
+def _cursor_value(obj):
+    # str() of dates matches what sqlite stores and what python_value parses
+    return str(obj)
+
+
+def encode_cursor(direction, signature, values):
+    """Opaque keyset pagination token"""
+    payload = json.dumps({'d': direction, 's': signature, 'v': values},
+                         separators=(',', ':'), default=_cursor_value)
+    token = base64.urlsafe_b64encode(payload.encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    token = str(token)
+    token += '=' * (-len(token) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii'))
+                         .decode('utf-8'))
+    return payload['d'], payload['s'], payload['v']
+
+
+def _resource_href(**args):
+    """href relative to the api root like eve's own pagination links"""
+    path = request.path.strip('/')
+    for prefix in (config.URL_PREFIX, config.API_VERSION):
+        if prefix and path.startswith(prefix + '/'):
+            path = path[len(prefix) + 1:]
+    query = request.args.copy()
+    for k, v in args.items():
+        query.pop(k, None)
+        if v is not None:
+            query[k] = v
+    return '%s?%s' % (path, url_encode(query)) if query else path
 
 
 def validate_filters(where, resource):
+    """Uncached filter validation, EvePeewee uses compile_filter_validator"""
     allowed = config.DOMAIN[resource]['allowed_filters']
     if '*' in allowed or not config.VALIDATE_FILTERS:
         return None
+    check = compile_filter_validator(allowed, config.DOMAIN[resource]['schema'])
+    return check(where)
+
+
+def _filter_rules(field_schema):
+    """field_schema without the rules plain cerberus doesn't know (eve's
+    unique, data_relation, ...), nested schemas included
+    """
+    rules = {}
+    for rule, value in field_schema.items():
+        if rule not in ('required', 'nullable') and \
+                not hasattr(Validator, '_validate_' + rule):
+            continue
+        if rule == 'schema' and isinstance(value, dict):
+            if field_schema.get('type') == 'list':
+                value = _filter_rules(value)
+            else:
+                value = dict((k, _filter_rules(v)) for k, v in value.items())
+        rules[rule] = value
+    return rules
+
+
+def compile_filter_validator(allowed, schema, validators=None, lock=None):
+    """Returns a callable checking a where dict against allowed_filters and
+    the schema, which returns an error message or None. Cerberus validators
+    are taken from (and added to) `validators` keyed by field, `lock`
+    serializes their use as they keep state while validating.
+    """
+    if '*' in allowed:
+        return lambda where: None
+    allowed = frozenset(allowed)
+    if validators is None:
+        validators = {}
+    if lock is None:
+        lock = threading.Lock()
+
+    def check(where):
+        for key, value in where.items():
+            if key in where_combinators:
+                for sub in value if isinstance(value, list) else [value]:
+                    error = check(sub) if isinstance(sub, dict) else \
+                        "'%s' takes a list of documents" % key
+                    if error:
+                        return error
+                continue
+            if key not in allowed:
+                base = _json_base(key)
+                if base != key and base in allowed and \
+                        (schema.get(base) or {}).get('type') in ('dict', 'list'):
+                    # path, containment or key filter inside a JSON field
+                    continue
+                return "filter on '%s' not allowed" % key
+            if key not in schema:
+                return "filter on '%s' is invalid" % key
+            v = validators.get(key)
+            if v is None:
+                v = validators[key] = Validator({key: _filter_rules(schema[key])})
+            operands = [value]
+            if _is_operator_dict(value):
+                # the items of $in/$nin lists are checked one by one
+                operands = []
+                for name, arg in value.items():
+                    operands.extend(arg if isinstance(arg, list) and
+                                    name in ('$in', '$nin') else [arg])
+            for operand in operands:
+                with lock:
+                    valid = v.validate({key: operand})
+                if not valid:
+                    return "filter on '%s' is invalid" % key
+        return None
+    return check
 
-    for key, value in where.items():
-        if key not in allowed:
-            return "filter on '%s' not allowed" % key
 
-        res_schema = config.DOMAIN[resource]['schema']
-        if key not in res_schema:
-            return "filter on '%s' is invalid" % key
-        else:
-            field_schema = res_schema.get(key)
-            v = Validator({key: field_schema})
-            if not v.validate({key: value}):
-                return "filter on '%s' is invalid" % key
-            else:
-                return None
+@requires_auth('resource')
+def export_resource(resource, **lookup):
+    """Streams a whole collection, see EvePeewee.export"""
+    return current_app.data.export_response(resource, lookup)
+
+
+def batch_operations():
+    """Runs the posted list of writes, see EvePeewee.batch"""
+    return current_app.data.batch_response()
+
+
+class _BatchAborted(Exception):
+    """Raised inside the batch transaction to roll it back"""
+
+
+def _api_prefix(app):
+    return '/'.join(p for p in (app.config.get('URL_PREFIX'),
+                                app.config.get('API_VERSION')) if p)
 
 
 class EvePeewee(DataLayer):
@@ -110,6 +533,102 @@ class EvePeewee(DataLayer):
         'datetime': str_to_date
     }
 
+    #: query string argument carrying the keyset pagination token
+    cursor_arg = 'cursor'
+
+    #: how the total for collection GETs is found, see _count
+    count_strategies = ('exact', 'window', 'estimate', 'has_more', 'cached')
+
+    #: export formats and their content types
+    export_formats = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+    }
+
+    #: alias of the COUNT(*) OVER() column added by the window strategy
+    window_count_alias = '_eve_peewee_total'
+
+    #: alias prefix of related columns joined in for embedding
+    embed_alias_prefix = '_eve_peewee_embed__'
+
+    #: accumulators of aggregation $group stages
+    aggregate_functions = {'$sum': 'SUM', '$avg': 'AVG', '$min': 'MIN',
+                           '$max': 'MAX'}
+
+    #: comparison operators of where clauses and aggregation $match stages
+    match_operators = {
+        '$eq': operator.eq, '$ne': operator.ne,
+        '$gt': operator.gt, '$gte': operator.ge,
+        '$lt': operator.lt, '$lte': operator.le,
+        '$in': operator.lshift, '$nin': lambda f, v: f.not_in(v),
+    }
+
+    #: nesting of $and/$or/$nor and number of conditions (counting $in/$nin
+    #: items) allowed in a where clause
+    max_where_depth = 8
+    max_where_size = 500
+
+    #: aggregation stages in the order they can appear, $having being a
+    #: $match after $group
+    aggregate_stages = ('$match', '$group', '$having', '$sort', '$skip', '$limit')
+
+    #: methods of batch operations, True for the ones addressing an item
+    batch_methods = {'POST': False, 'PATCH': True, 'PUT': True, 'DELETE': True}
+
+    #: bound parameters allowed per statement, bulk inserts are chunked to fit
+    max_query_params = (
+        (peewee.SqliteDatabase, 999),
+        (peewee.PostgresqlDatabase, 65535),
+        (peewee.MySQLDatabase, 65535),
+    )
+
+    def _resource_option(self, resource, name, default=None):
+        """Per-resource setting from the resource's '_peewee' dict, falls back
+        to app-wide PEEWEE_<NAME>
+        """
+        opts = self.app.config['DOMAIN'][resource].get('_peewee') or {}
+        if name in opts:
+            return opts[name]
+        return self.app.config.get('PEEWEE_' + name.upper(), default)
+
+    def _filter_validator(self, resource):
+        """Compiled filter validation for resource, cached per allowed_filters
+        setting until invalidate_filter_validators
+        """
+        allowed = config.DOMAIN[resource]['allowed_filters']
+        key = (resource, tuple(allowed))
+        check = self._filter_checks.get(key)
+        if check is None:
+            check = compile_filter_validator(
+                allowed, config.DOMAIN[resource]['schema'],
+                self._filter_validators.setdefault(resource, {}),
+                self._filter_lock)
+            self._filter_checks[key] = check
+        return check
+
+    def invalidate_filter_validators(self, resource=None):
+        """Drops cached filter validation, needed after changing a resource
+        schema at runtime
+        """
+        for key in list(self._filter_checks):
+            if resource is None or key[0] == resource:
+                del self._filter_checks[key]
+        for res in list(self._filter_validators):
+            if resource is None or res == resource:
+                del self._filter_validators[res]
+
+    def _build_filter_validators(self, resource_def):
+        validators = {}
+        allowed = resource_def.get('allowed_filters') or []
+        schema = resource_def.get('schema') or {}
+        if '*' in allowed:
+            return validators
+        for key in allowed:
+            if key not in schema:
+                continue
+            validators[key] = Validator({key: _filter_rules(schema[key])})
+        return validators
+
     def _get_model_cls(self, resource):
         try:
             return self.models[resource]
@@ -121,8 +640,8 @@ class EvePeewee(DataLayer):
         # TODO: custom Validator
         for field_name,fs in config.DOMAIN[resource]['schema'].items():
           # if m:m then validate that all elements are ints
-          if 'data_relation' in fs and fs['type'] == 'list':
-            for f in doc[field_name]:
+          if _data_relation(fs) and fs['type'] == 'list':
+            for f in doc.get(field_name) or []:
               if not isinstance(f, int):
                 abort(400, "value '%s' cannot be converted to int" % f)
         instance = cls(**doc)
@@ -141,18 +660,30 @@ class EvePeewee(DataLayer):
             abort(400, description=str(exc))
 
     def combine_queries(self, query_a, query_b):
-        # spec ends up in _parse_where which only supports and-ops right now
+        """Query matching both: merged when their keys don't overlap, so the
+        plain keys keep their cached query plan, $and'ed otherwise so neither
+        can override the other
+        """
+        if not query_a or not query_b:
+            return dict(query_a or query_b or {})
+        if set(query_a) & set(query_b):
+            return {'$and': [query_a, query_b]}
         z = query_a.copy()
         z.update(query_b)
         return z
 
     def get_value_from_query(self, query, field_name):
         """ For the specified field name, parses the query and returns
-        the value being assigned in the query.
+        the value being assigned in the query, also looking into $and.
         """
         for fn,cond in query.items():
             if fn == field_name or fn.startswith(field_name+'__'):
                 return cond
+        for condition in query.get('$and') or []:
+            try:
+                return self.get_value_from_query(condition, field_name)
+            except (KeyError, AttributeError):
+                pass
         raise KeyError
 
     def query_contains_field(self, query, field_name):
@@ -164,9 +695,152 @@ class EvePeewee(DataLayer):
             return False
         return True
 
+    def _json_term(self, model, key):
+        """Filter on the inside of a JSON field: 'field.path.to.value__op'
+        compares the value at the path (op from json_operators, eq if left
+        out), 'field[.path]__contains' tests containment and
+        'field[.path]__has_key' a key's presence. Returns a callable building
+        the expression for the filter value: jsonb operators on postgres,
+        JSON1 functions elsewhere.
+        """
+        path, _, op = key.partition('__')
+        op = op or 'eq'
+        if op not in json_operators and op not in ('contains', 'has_key'):
+            abort(400, description='Unsupported JSON filter: %s' % key)
+        parts = path.split('.')
+        field = getattr(model, parts[0])
+        if isinstance(field, MsgpackField):
+            abort(400, description='%s is stored as msgpack and can\'t be '
+                  'filtered on' % parts[0])
+        path = [_json_key(p) for p in parts[1:]]
+        if isinstance(model._meta.database, peewee.PostgresqlDatabase):
+            return _pg_json_term(field, path, op)
+        return _sqlite_json_term(field, path, op)
+
+    def _split_json_where(self, model, where):
+        """where keys addressing the inside of JSON fields, and the rest"""
+        json_fields = self._json_fields.get(model, ())
+        json_keys = [k for k in where if k not in model._meta.fields
+                     and _json_base(k) in json_fields]
+        if not json_keys:
+            return [], where
+        return json_keys, dict((k, v) for k, v in where.items()
+                               if k not in json_keys)
+
+    def _check_where(self, spec):
+        """Aborts with 400 unless spec is a where document within
+        max_where_depth and max_where_size
+        """
+        size = 0
+        stack = [(spec, 1)]
+        while stack:
+            doc, depth = stack.pop()
+            if not isinstance(doc, dict):
+                abort(400, description='Invalid where clause: %s' % (doc,))
+            if depth > self.max_where_depth:
+                abort(400, description='where clause nested too deeply')
+            for key, value in doc.items():
+                if key in where_combinators and isinstance(value, list):
+                    stack.extend((sub, depth + 1) for sub in value)
+                    continue
+                size += 1
+                if _is_operator_dict(value):
+                    size += sum(len(arg) for arg in value.values()
+                                if isinstance(arg, list))
+            if size > self.max_where_size:
+                abort(400, description='where clause has too many conditions')
+
+    def _where_expression(self, model, spec):
+        """Single expression for a where document: its keys and'ed, $and,
+        $or and $nor taking lists of documents, fields compared for
+        equality (or as 'field__op' like peewee lookups) or with {$op:
+        value} of match_operators. Related field lookups aren't supported.
+        """
+        if not isinstance(spec, dict) or not spec:
+            abort(400, description='Invalid where clause: %s' % (spec,))
+        terms = []
+        for key, value in sorted(spec.items()):
+            if key.startswith('$'):
+                if key not in where_combinators:
+                    abort(400, description='Unsupported operator: %s' % key)
+                if not isinstance(value, list) or not value:
+                    abort(400, description='%s takes a list of documents' % key)
+                if key == '$and':
+                    terms.append(reduce(operator.and_, [
+                        self._where_expression(model, sub) for sub in value]))
+                else:
+                    either = self._or_expression(model, value)
+                    terms.append(~either if key == '$nor' else either)
+            elif key not in model._meta.fields and \
+                    _json_base(key) in self._json_fields.get(model, ()):
+                if not _is_operator_dict(value):
+                    terms.append(self._json_term(model, key)(value))
+                    continue
+                for name, arg in sorted(value.items()):
+                    if name[1:] not in json_operators:
+                        abort(400, description='Unsupported JSON filter: %s %s'
+                              % (key, name))
+                    terms.append(self._json_term(
+                        model, '%s__%s' % (key, name[1:]))(arg))
+            elif _is_operator_dict(value):
+                if key not in model._meta.fields:
+                    abort(400, description='Unknown field name: %s' % key)
+                field = model._meta.fields[key]
+                for name, arg in sorted(value.items()):
+                    if name not in self.match_operators:
+                        abort(400, description='Unsupported operator: %s' % name)
+                    if name in ('$in', '$nin') and not isinstance(arg, list):
+                        abort(400, description='%s takes a list' % name)
+                    terms.append(self.match_operators[name](field, arg))
+            else:
+                try:
+                    nodes, joins = model.select().convert_dict_to_node(
+                        {key: value})
+                except AttributeError:
+                    abort(400, description='Unknown field name: %s' % key)
+                if joins:
+                    abort(400, description='Related field lookups can\'t be '
+                          'combined with $and, $or or $nor: %s' % key)
+                terms.extend(nodes)
+        return reduce(operator.and_, terms)
+
+    def _or_expression(self, model, specs):
+        """$or of specs, an IN list when they all compare the same field
+        for equality (or with $in) so its index can be used
+        """
+        name, values = None, []
+        for spec in specs:
+            if not isinstance(spec, dict) or len(spec) != 1:
+                break
+            key, value = list(spec.items())[0]
+            if isinstance(value, dict) and list(value) == ['$in'] and \
+                    isinstance(value['$in'], list):
+                value = value['$in']
+            elif value is None or isinstance(value, (dict, list)):
+                break
+            else:
+                value = [value]
+            if key not in model._meta.fields or name not in (None, key):
+                break
+            name = key
+            values.extend(value)
+        else:
+            return model._meta.fields[name] << values
+        return reduce(operator.or_, [self._where_expression(model, spec)
+                                     for spec in specs])
+
     def _parse_where(self, op, where):
+        bool_keys = [k for k in where if _is_boolean_key(k, where[k])]
+        json_keys, plain = self._split_json_where(
+            op.model_class,
+            dict((k, v) for k, v in where.items() if k not in bool_keys))
         try:
-            query,joins = op.convert_dict_to_node(where)
+            query,joins = op.convert_dict_to_node(plain)
+            query = list(query) + [self._json_term(op.model_class, k)(where[k])
+                                   for k in json_keys]
+            if bool_keys:
+                query.append(self._where_expression(
+                    op.model_class, dict((k, where[k]) for k in bool_keys)))
             if len(query):
                 return op.filter(reduce(operator.and_, query))
             else:
@@ -180,26 +854,155 @@ class EvePeewee(DataLayer):
         if name in self._eve_peewee_field_map:
             fld = self._eve_peewee_field_map[name]
         elif name == 'dict' or name == 'list':
-            # TODO: db agnostic
-            from playhouse.postgres_ext import BinaryJSONField
-            fld = BinaryJSONField
+            fld = self._json_field_type()
         return fld
 
-    def _get_driver(self, dburi):
+    def _json_field_type(self):
+        """jsonb on postgres, elsewhere PEEWEE_JSON_STORAGE: 'text' (compact
+        JSON, filterable through JSON1) or 'msgpack' (smaller, no filters)
+        """
+        if isinstance(self.driver, peewee.PostgresqlDatabase):
+            from playhouse.postgres_ext import BinaryJSONField
+            return BinaryJSONField
+        storage = self.app.config.get('PEEWEE_JSON_STORAGE', 'text')
+        if storage == 'msgpack':
+            return MsgpackField
+        elif storage == 'text':
+            return JSONTextField
+        raise ValueError('unknown PEEWEE_JSON_STORAGE: %s' % storage)
+
+    def _get_driver(self, dburi, **options):
         """assigns eve.data.driver based on config.DATABASE_URI
         Override for any atypical db needs
         """
         # NOTE: if there's an uncaptured db exception and rollback doesn't
         # happen then the site is down until restart, could do autorollback=True?
         parsed = db_url.urlparse(dburi)
-        class RetryDB(RetryOperationalError, db_url.schemes[parsed.scheme]):
+        base = db_url.schemes[parsed.scheme]
+        retry = PooledRetryOperationalError \
+            if issubclass(base, PooledDatabase) else RetryOperationalError
+        class RetryDB(retry, base):
             pass
-        return RetryDB(**db_url.parse(dburi))
+        kwargs = db_url.parse(dburi)
+        kwargs.update(options)
+        return RetryDB(**kwargs)
+
+    def _pool_options(self, dburi, app_config):
+        """playhouse.pool arguments for +pool schemes (postgres+pool://,
+        sqlite+pool://, ...) from DATABASE_POOL_MAX_CONNECTIONS,
+        DATABASE_POOL_STALE_TIMEOUT and DATABASE_POOL_TIMEOUT (seconds to wait
+        for a free connection)
+        """
+        if not db_url.urlparse(dburi).scheme.endswith('+pool'):
+            return {}
+        options = {
+            'max_connections': app_config.get('DATABASE_POOL_MAX_CONNECTIONS', 20),
+            'stale_timeout': app_config.get('DATABASE_POOL_STALE_TIMEOUT', 300),
+        }
+        if app_config.get('DATABASE_POOL_TIMEOUT') is not None:
+            options['timeout'] = app_config['DATABASE_POOL_TIMEOUT']
+        return options
+
+    def _setup_replicas(self, app_config):
+        """Read replicas from DATABASE_REPLICA_URIS, chosen per request
+        round-robin or by least-load (fewest requests reading from it) with
+        DATABASE_REPLICA_STRATEGY
+        """
+        self.replicas = [self._get_driver(uri, **self._pool_options(uri, app_config))
+                         for uri in app_config.get('DATABASE_REPLICA_URIS') or []]
+        self.replica_strategy = app_config.get('DATABASE_REPLICA_STRATEGY',
+                                               'round-robin')
+        if self.replica_strategy not in ('round-robin', 'least-load'):
+            raise ValueError('unknown DATABASE_REPLICA_STRATEGY: %s'
+                             % self.replica_strategy)
+        self._replica_lock = threading.Lock()
+        self._replica_load = [0] * len(self.replicas)
+        self._replica_next = 0
+        # clients that wrote recently read from the primary
+        self.read_your_writes = app_config.get('DATABASE_READ_YOUR_WRITES', 5)
+        self._recent_writers = LRUCache(
+            app_config.get('DATABASE_READ_YOUR_WRITES_CLIENTS', 10000),
+            self.read_your_writes)
+
+    def _client_key(self):
+        """Identifies the client for read-your-writes, override for other
+        auth schemes
+        """
+        auth = request.authorization
+        return auth.username if auth else request.remote_addr
+
+    def _pick_replica(self):
+        with self._replica_lock:
+            if self.replica_strategy == 'least-load':
+                loads = self._replica_load
+                index = loads.index(min(loads))
+            else:
+                index = self._replica_next
+                self._replica_next = (index + 1) % len(self.replicas)
+            self._replica_load[index] += 1
+        return index
+
+    def _read_database(self):
+        """Database for reads: the request's replica for GET/HEAD requests,
+        the primary for writes, transactions, work outside requests and
+        clients that wrote less than DATABASE_READ_YOUR_WRITES seconds ago
+        """
+        if not self.replicas or not has_request_context() or \
+                request.method not in ('GET', 'HEAD') or \
+                self.driver.transaction_depth() or \
+                getattr(g, '_eve_peewee_wrote', False) or \
+                self._recent_writers.get(self._client_key()):
+            return self.driver
+        index = getattr(g, '_eve_peewee_replica', None)
+        if index is None:
+            index = g._eve_peewee_replica = self._pick_replica()
+        return self.replicas[index]
+
+    def _record_write(self):
+        """Sends the client's reads to the primary for a while"""
+        if not self.replicas or not has_request_context():
+            return
+        g._eve_peewee_wrote = True
+        if self.read_your_writes:
+            self._recent_writers.set(self._client_key(), True)
+
+    def _release_replica(self, exc=None):
+        index = getattr(g, '_eve_peewee_replica', None)
+        if index is None:
+            return
+        g._eve_peewee_replica = None
+        with self._replica_lock:
+            self._replica_load[index] -= 1
+
+    def _connect_db(self):
+        """Checks a pooled connection out for the duration of a request"""
+        if self.driver.is_closed():
+            self.driver.connect()
+
+    def _close_db(self, exc=None):
+        """Returns the request's connections to the pool"""
+        for db in [self.driver] + self.replicas:
+            if db.is_closed() or not isinstance(db, PooledDatabase):
+                continue
+            if exc is not None:
+                try:
+                    db.rollback()
+                except Exception as err:
+                    self.app.logger.warn(err)
+            db.close()
+
 
+    def _count_strategy_header(self, response):
+        """Reports how the total of a collection GET was computed"""
+        strategy = getattr(g, '_eve_peewee_count_strategy', None)
+        if strategy:
+            response.headers['X-Count-Strategy'] = strategy
+        return response
 
     def _create_model(self, res_name, base={}):
         class Meta:
             database = self.driver
+            read_database = self._read_database
 
         if 'Meta' not in base:
             base['Meta'] = Meta
@@ -216,7 +1019,20 @@ class EvePeewee(DataLayer):
         """
         # eve.utils.config is not yet setup so use app.config here
         if 'DATABASE_URI' in app.config:
-            self.driver = self._get_driver(app.config['DATABASE_URI'])
+            dburi = app.config['DATABASE_URI']
+            self.driver = self._get_driver(dburi, **self._pool_options(dburi, app.config))
+        self._setup_replicas(app.config)
+
+        if isinstance(self.driver, PooledDatabase):
+            # connections follow requests instead of staying with threads
+            app.before_request(self._connect_db)
+        if any(isinstance(db, PooledDatabase) for db in [self.driver] + self.replicas):
+            app.teardown_request(self._close_db)
+        app.teardown_request(self._release_replica)
+        app.after_request(self._count_strategy_header)
+
+        app.on_delete_resource += self._on_delete_resource
+        app.on_pre_GET += self._on_pre_get
 
         # mapping from eve field schema properties to peewee properties
         pw_eve_fld_prop_map = {
@@ -228,7 +1044,31 @@ class EvePeewee(DataLayer):
 
         self.models = {}
         self.link_tables = {}
-
+        # model -> names of its dict/list (JSON) fields
+        self._json_fields = {}
+        # resource -> {field: (related resource, link table name or None)}
+        self.relations = {}
+        self.query_plans = LRUCache(app.config.get('PEEWEE_QUERY_CACHE_SIZE', 256))
+        self._filter_lock = threading.Lock()
+        self._filter_checks = {}
+        self._filter_validators = {}
+        if app.config.get('VALIDATE_FILTERS'):
+            for res_name, v in app.config['DOMAIN'].items():
+                self._filter_validators[res_name] = self._build_filter_validators(v)
+        self._prepared = {}
+        self._count_cache = LRUCache(
+            app.config.get('PEEWEE_COUNT_CACHE_SIZE', 1024),
+            app.config.get('PEEWEE_COUNT_CACHE_TTL', 60))
+        # any object with get(key) and set(key, value, ttl), ttl 0 meaning
+        # no expiry, e.g. a wrapper around a cache shared by the workers
+        self.result_cache = app.config.get('PEEWEE_RESULT_CACHE_BACKEND') or \
+            LRUCache(app.config.get('PEEWEE_RESULT_CACHE_SIZE', 1024))
+        # max(_updated) read from the database, and the time of this
+        # process' last write per resource
+        self._modified = LRUCache(1024, app.config.get('PEEWEE_LAST_MODIFIED_TTL', 5))
+        self._high_water = {}
+
+        started = time.time()
         for res_name, v in app.config['DOMAIN'].items():
             if 'schema' not in v: continue
 
@@ -248,7 +1088,7 @@ class EvePeewee(DataLayer):
                 else:
                     args['null'] = not fs['required']
 
-                if 'data_relation' in fs and fs['data_relation']:
+                if _data_relation(fs):
                     continue
                 elif 'primary_key' in fs and fs['primary_key']:
                     fld = peewee.PrimaryKeyField(**args)
@@ -269,40 +1109,145 @@ class EvePeewee(DataLayer):
             mod = self._create_model(res_name, base)
 
             self.models[res_name] = mod
+            self._json_fields[mod] = set(
+                name for name, fs in v['schema'].items()
+                if fs.get('type') in ('dict', 'list') and not _data_relation(fs))
 
         # second pass for foreign keys
         for res_name, v in app.config['DOMAIN'].items():
+            self.relations[res_name] = {}
             for field_name,fs in v['schema'].items():
-                if 'data_relation' in fs and fs['data_relation']:
-                    rel_name = fs['data_relation']['resource']
-                    fld = peewee.ForeignKeyField(self.models[rel_name], **args)
+                rel = _data_relation(fs)
+                if rel:
+                    rel_name = rel['resource']
 
                     # m:m
                     if fs['type'] == 'list':
-                        self.link_tables[res_name +'_'+ rel_name] = (res_name, rel_name)
+                        tn = res_name +'_'+ rel_name
+                        self.link_tables[tn] = (res_name, rel_name)
+                        self.relations[res_name][field_name] = (rel_name, tn)
                     # 1:m
                     else:
+                        args = {'null': not fs.get('required', False)}
+                        args.update(fs.get('_peewee') or {})
+                        fld = peewee.ForeignKeyField(self.models[rel_name], **args)
                         fld.add_to_class(self.models[res_name], field_name)
+                        self.relations[res_name][field_name] = (rel_name, None)
 
         for tn,lt in self.link_tables.items():
             if not isinstance(lt, tuple): continue
+            class Meta:
+                database = self.driver
+                read_database = self._read_database
+                # one row per pair, also serves the lookups by parent
+                indexes = ((lt, True),)
             linkbase = {'Meta':Meta}
             # peewee adds _id suffix for fkeys
-            linkbase[lt[0]] = peewee.ForeignKeyField(self.models[lt[1]])
-            linkbase[lt[1]] = peewee.ForeignKeyField(self.models[lt[0]])
+            linkbase[lt[0]] = peewee.ForeignKeyField(self.models[lt[0]])
+            linkbase[lt[1]] = peewee.ForeignKeyField(self.models[lt[1]])
             mod = type(tn, (BaseModel,), linkbase)
             # TRIVIA: if unitialized Model is added to list with += it causes
             # Model.__iter__ to call select() on non-existing table
             self.link_tables[tn] = mod
 
+        # resources whose documents embed those of another, directly or not
+        self._dependents = {}
+        for res_name, fields in self.relations.items():
+            for rel_name, _ in fields.values():
+                self._dependents.setdefault(rel_name, set()).add(res_name)
+        changed = True
+        while changed:
+            changed = False
+            for deps in self._dependents.values():
+                for res_name in list(deps):
+                    more = self._dependents.get(res_name, set()) - deps
+                    if more:
+                        deps |= more
+                        changed = True
+
             #if 'datasource' in v and 'source' in v['datasource']:
 
         #import pdb; pdb.set_trace()
         tables = list(self.models.values())
         tables += list(self.link_tables.values())
-        self.driver.create_tables(tables, safe=True)
+        self.startup_timings = {'models': time.time() - started}
+
+        # with PEEWEE_SCHEMA_FINGERPRINT only the first worker booting with a
+        # changed DOMAIN runs the DDL, the others check a hash in one query
+        started = time.time()
+        if app.config.get('PEEWEE_SCHEMA_FINGERPRINT') and \
+                app.config.get('PEEWEE_MIGRATE') != 'check':
+            synchronize_schema(self.driver, self.schema_fingerprint(app.config),
+                               lambda: self._create_schema(app.config))
+        else:
+            self._create_schema(app.config)
+        self.startup_timings['schema'] = time.time() - started
+        logger.info('generated %d models and %d link tables in %.3fs, '
+                    'schema set up in %.3fs', len(self.models),
+                    len(self.link_tables), self.startup_timings['models'],
+                    self.startup_timings['schema'])
+
+        self._register_exports(app)
+        self._register_batch(app)
+
+    def _create_schema(self, app_config):
+        tables = list(self.models.values()) + list(self.link_tables.values())
+        # 'check' reports how the database differs from DOMAIN, 'apply'
+        # migrates it, see eve_peewee.migrate
+        migrate = app_config.get('PEEWEE_MIGRATE')
+        if migrate == 'apply':
+            apply_migration(self.migration_plan(app_config))
+        elif migrate == 'check':
+            check_migration(self.migration_plan(app_config))
+        else:
+            self.driver.create_tables(tables, safe=True)
+            # tables created before etags were stored lack the column
+            add_missing_columns(tables, self.driver, ['_etag'])
+
+            # True creates indexes for filters and sorts, 'dry-run' only logs them
+            auto_index = app_config.get('PEEWEE_AUTO_INDEX', False)
+            if auto_index:
+                provision_indexes(self.models, app_config['DOMAIN'], self.driver,
+                                  app_config['ID_FIELD'],
+                                  dry_run=auto_index == 'dry-run',
+                                  conditional_get=app_config.get(
+                                      'PEEWEE_CONDITIONAL_GET', False))
+
+    def schema_fingerprint(self, app_config=None):
+        """Hash of the DDL generated from DOMAIN and the settings deciding
+        what init_app does with it
+        """
+        app_config = app_config or self.app.config
+        tables = list(self.models.values()) + list(self.link_tables.values())
+        auto_index = app_config.get('PEEWEE_AUTO_INDEX', False)
+        indexes = []
+        if auto_index:
+            indexes = plan_indexes(self.models, app_config['DOMAIN'],
+                                   self.driver, app_config['ID_FIELD'],
+                                   app_config.get('PEEWEE_CONDITIONAL_GET', False))
+        return schema_fingerprint(tables, self.driver, indexes,
+                                  [app_config.get('PEEWEE_MIGRATE'), auto_index])
+
+    def migration_plan(self, app_config=None):
+        """Schema changes needed for the database to match DOMAIN, including
+        the indexes of PEEWEE_AUTO_INDEX
+        """
+        app_config = app_config or self.app.config
+        tables = list(self.models.values()) + list(self.link_tables.values())
+        indexes = []
+        if app_config.get('PEEWEE_AUTO_INDEX'):
+            indexes = plan_indexes(self.models, app_config['DOMAIN'],
+                                   self.driver, app_config['ID_FIELD'],
+                                   app_config.get('PEEWEE_CONDITIONAL_GET', False))
+        return plan_migration(tables, self.driver, indexes)
 
     def _find(self, resource, req, **lookup):
+        return self._build_find(resource, req, **lookup)[0]
+
+    def _build_find(self, resource, req, **lookup):
+        """Builds the select for resource, returns it with the active sort
+        as a list of (field, ascending) pairs
+        """
         sort = []
         spec = {}
 
@@ -316,35 +1261,31 @@ class EvePeewee(DataLayer):
                 except ValueError as exc:
                     self.app.logger.exception(exc)
                     abort(400, description='Unable to parse `where` clause')
+                self._check_where(spec)
 
             if config.VALIDATE_FILTERS:
-                bad_filter = validate_filters(spec, resource)
+                bad_filter = self._filter_validator(resource)(spec)
                 if bad_filter:
                     abort(400, bad_filter)
 
             if config.DOMAIN[resource]['soft_delete'] and not req.show_deleted:
                 # Soft delete filtering applied after validate_filters call as
                 # querying against the DELETED field must always be allowed when
-                # soft_delete is enabled
-                #spec[config.DELETED+'__ne'] = True
-                if not self.query_contains_field(spec, config.DELETED):
-                    spec = self.combine_queries(spec, {config.DELETED+'__ne': True})
+                # soft_delete is enabled, it can't widen the results though.
+                # equality (the column isn't nullable) so partial indexes on
+                # _deleted = false apply
+                spec = self.combine_queries(spec, {config.DELETED: False})
 
             if req.sort:
                 for sort_arg in [s.strip() for s in req.sort.split(",")]:
                     sn = sort_arg[1:] if sort_arg[0] == "-" else sort_arg
-                    try:
-                        if sort_arg[0] == "-":
-                            sort.append(getattr(model, sn).desc())
-                        else:
-                            sort.append(getattr(model, sn))
-                    except AttributeError:
+                    if sn not in model._meta.fields:
                         abort(400, description='Unknown field name: %s' % sn)
+                    sort.append((sn, -1 if sort_arg[0] == "-" else 1))
 
         if 'lookup' in lookup and lookup['lookup']:
             spec = self.combine_queries(
                 spec, lookup['lookup'])
-            spec = lookup['lookup']
 
         client_projection = self._client_projection(req)
 
@@ -354,7 +1295,31 @@ class EvePeewee(DataLayer):
             client_projection,
             sort)
 
+        sort = [tuple(s) for s in sort or []]
+        # soft_delete decides whether _deleted is selected (auto_fields)
+        key = (resource, config.DOMAIN[resource]['soft_delete'],
+               tuple((k, spec[k] is None, _is_operator_dict(spec[k]))
+                     for k in sorted(spec)),
+               tuple(sort),
+               tuple(sorted(projection.items())))
+        try:
+            plan = self.query_plans.get(key)
+        except TypeError:
+            # unhashable shape, e.g. nested values in the projection
+            plan, key = None, None
+        if plan is None:
+            plan = self._query_plan(resource, model, spec, sort, projection)
+            if key is not None:
+                self.query_plans.set(key, plan)
+
+        return plan.bind(model, spec), plan.sort
+
+    def _query_plan(self, resource, model, spec, sort, projection):
+        """Resolves projection, where keys and sort of a query shape to
+        model fields
+        """
         # TODO? http://eve-sqlalchemy.readthedocs.org/en/latest/tutorial.html#embedded-resources
+        fields = []
         if len(projection):
             fields = [getattr(model, config.ID_FIELD)]
             exclude_only = all(not v for v in projection.values())
@@ -368,109 +1333,1333 @@ class EvePeewee(DataLayer):
                 # if not an auto_field and not projected out
                 if f not in keep_fields and not any(check_list): continue
                 fields.append(getattr(model, f))
-            op = model.select(*fields)
-        else:
-            op = model.select()
-
-        op = self._parse_where(op, spec)
-
-        if sort:
-            def fix_sort(sort_arg):
-                # default sort takes [('fname',1)]
-                if not isinstance(sort_arg, tuple):
-                    return sort_arg
-                sn,asc = sort_arg
-                sortf = getattr(model, sn)
-                if not asc: sortf = sortf.desc()
-                return sortf
 
-            sort = map(fix_sort, sort)
-            op = op.order_by(*sort)
-
-        return op
+        # $and/$or/$nor and {$op: value} terms are compiled per value
+        bool_keys = sorted(k for k in spec if _is_boolean_key(k, spec[k]))
+        json_keys, spec = self._split_json_where(
+            model, dict((k, v) for k, v in spec.items() if k not in bool_keys))
+        # values only matter to convert_dict_to_node when they're None
+        shape = dict((k, None if v is None else _WHERE_PARAM)
+                     for k, v in spec.items())
+        try:
+            nodes, joins = model.select().convert_dict_to_node(shape)
+        except AttributeError as exc:
+            self.app.logger.warn("missing field?")
+            self._handle_exception(exc)
+        # nodes come in sorted key order
+        terms = [(k, n.lhs, n.op, None) for k, n in zip(sorted(shape), nodes)]
+        terms += [(k, None, None, self._json_term(model, k)) for k in json_keys]
+        terms += [(k, None, None,
+                   lambda value, k=k: self._where_expression(model, {k: value}))
+                  for k in bool_keys]
+
+        # default sort takes [('fname', 1)] with -1 for descending
+        sort = [(getattr(model, sn), asc > 0) for sn, asc in sort]
+        return QueryPlan(fields, terms, bool(joins), sort)
+
+    def query_plan_stats(self):
+        """hits, misses and size of the query plan cache"""
+        return self.query_plans.stats()
+
+    def _result_cache_key(self, resource, kind, req, lookup):
+        """Key of a find/find_one result in the result cache, None if it
+        isn't cached: resources without the 'result_cache' option, requests
+        other than GET/HEAD, finds without max_results and requests
+        embedding documents aren't.
+        The key includes the resource's generation, see _invalidate, and
+        the request auth value of auth_field resources.
+        """
+        if req is None or not has_request_context() or \
+                request.method not in ('GET', 'HEAD') or \
+                not self._resource_option(resource, 'result_cache', False):
+            return None
+        if kind == 'find' and not req.max_results:
+            return None
+        if resolve_embedded_fields(resource, req):
+            # a hit would skip filling the embed store, eve would then
+            # look up the embedded documents one by one
+            return None
+
+        def normalized(value):
+            try:
+                return json.loads(value) if value else None
+            except ValueError:
+                return value
+        parts = [kind, normalized(req.where), normalized(req.projection),
+                 req.sort, req.page, req.max_results,
+                 normalized(req.embedded), req.show_deleted,
+                 request.args.get(self.cursor_arg), lookup]
+        if config.DOMAIN[resource].get('auth_field'):
+            # users only see their own documents, see _datasource_ex
+            parts.append(auth_field_and_value(resource))
+        digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str)
+                              .encode('utf-8')).hexdigest()
+        return 'eve_peewee:%s:%s:%s' % (resource, self._generation(resource),
+                                        digest)
+
+    def _generation(self, resource):
+        key = 'eve_peewee:generation:' + resource
+        generation = self.result_cache.get(key)
+        if generation is None:
+            # unknown or evicted, nothing cached before can be trusted
+            generation = uuid.uuid4().hex
+            self.result_cache.set(key, generation, 0)
+        return generation
+
+    def _invalidate(self, resource):
+        """Drops the cached results of resource and of the resources
+        embedding it by moving them to a new generation
+        """
+        now = datetime.utcnow()
+        for res_name in set([resource]) | self._dependents.get(resource, set()):
+            self.result_cache.set('eve_peewee:generation:' + res_name,
+                                  uuid.uuid4().hex, 0)
+            self._high_water[res_name] = now
+
+    def last_modified(self, resource, where=None):
+        """Latest _updated of the documents of resource matching where (a
+        lookup dict), soft deleted ones included, or the time of this
+        process' last write to it if that's later. None for an empty
+        resource. The database's max(_updated) is kept for
+        PEEWEE_LAST_MODIFIED_TTL seconds, checks within that cost no query.
+        """
+        key = (resource, json.dumps(where, sort_keys=True, default=str)
+               if where else None)
+        latest = self._modified.get(key)
+        if latest is None:
+            cls = self._get_model_cls(resource)
+            op = cls.select(peewee.fn.MAX(cls._updated))
+            if where:
+                op = self._parse_where(op, where)
+            latest = cls._updated.python_value(op.scalar()) or False
+            self._modified.set(key, latest)
+        high_water = self._high_water.get(resource)
+        if high_water and (not latest or high_water > latest):
+            return high_water
+        return latest or None
+
+    def _on_pre_get(self, resource, req, lookup):
+        """on_pre_GET hook answering collection GETs with If-Modified-Since
+        from last_modified, for resources with the 'conditional_get' option.
+        Eve itself always sends collections in full.
+        """
+        if not resource or request.endpoint != resource + '|resource' or \
+                not self._resource_option(resource, 'conditional_get', False):
+            return
+        try:
+            since = weak_date(request.headers.get('If-Modified-Since'))
+        except ValueError:
+            return
+        if since is None:
+            return
+        latest = self.last_modified(resource)
+        # like eve, empty resources aren't 304
+        if latest is not None and latest <= since:
+            abort(Response(status=304, headers={
+                'Last-Modified': date_to_rfc1123(latest)}))
+
+    def _cache_result(self, resource, key, value):
+        self.result_cache.set(key, copy.deepcopy(value),
+                              self._resource_option(resource, 'result_cache_ttl', 60))
 
     def find_one(self, resource, req, **lookup):
-        rs = self._find(resource, req, lookup=lookup).limit(1).dicts()
-        return rs[0] if rs.count() else None
+        key = self._result_cache_key(resource, 'find_one', req, lookup)
+        if key is None:
+            return self._find_one(resource, req, **lookup)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            # eve adds links and meta fields to what it gets
+            return copy.deepcopy(cached)
+        doc = self._find_one(resource, req, **lookup)
+        if doc is not None:
+            self._cache_result(resource, key, doc)
+        return doc
+
+    def _find_one(self, resource, req, **lookup):
+        if list(lookup) == [config.ID_FIELD] and req is None:
+            # eve embeds documents one find_one at a time
+            doc = self._embed_store().get((resource, lookup[config.ID_FIELD]))
+            if doc is not None:
+                return _decode_json(dict(doc))
+
+        resource_def = config.DOMAIN[resource]
+        # the prepared statement would keep the filters of its first caller
+        filtered = resource_def.get('auth_field') or \
+            resource_def['datasource'].get('filter')
+        if list(lookup) == [config.ID_FIELD] and not filtered and \
+                not (req and (req.where or req.sort)):
+            doc = self._find_one_by_id(resource, req, lookup[config.ID_FIELD])
+        else:
+            doc = None
+            for doc in self._find(resource, req, lookup=lookup).limit(1).dicts():
+                break
+
+        if doc is not None and self.relations.get(resource):
+            self._attach_relations(resource, [doc],
+                                   self._embedded_fields(resource, req),
+                                   links=self._link_fields(resource, req))
+        if doc is not None:
+            _decode_json(_drop_null_etag(doc))
+        return doc
+
+    def _find_one_by_id(self, resource, req, id_):
+        """Primary key lookup used by item endpoints and etag checks.
+        The select is compiled once per resource (and soft delete/projection
+        variant) and executed straight on the cursor, no model instances.
+        Resource settings are read when the statement is first prepared, so
+        resources with an auth_field or a datasource filter don't use it.
+        """
+        hide_deleted = bool(req and config.DOMAIN[resource]['soft_delete']
+                            and not req.show_deleted)
+        key = (resource, hide_deleted, config.DOMAIN[resource]['soft_delete'],
+               req.projection if req else None)
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            model = self._get_model_cls(resource)
+            id_field = getattr(model, config.ID_FIELD)
+            # Passthrough skips the field's db_value, which can't convert
+            # the marker; the id is converted when the statement runs
+            op = self._find(resource, req).where(
+                id_field == peewee.Passthrough(_ID_PARAM))
+            op = op.order_by().limit(1)
+            sql, params = op.sql()
+            slots = [i for i, p in enumerate(params) if p is _ID_PARAM]
+            prepared = (sql, params, slots, id_field.db_value, self._row_columns(op))
+            self._prepared[key] = prepared
+
+        sql, params, slots, db_value, columns = prepared
+        params = list(params)
+        for i in slots:
+            params[i] = db_value(id_)
+        row = self._read_database().execute_sql(
+            sql, params, require_commit=False).fetchone()
+        if row is None:
+            return None
+        return self._row_dict(columns, row)
+
+    def _row_columns(self, op):
+        """(name, python_value) for each selected column of op"""
+        return [(getattr(n, '_alias', None) or n.name,
+                 n.python_value if isinstance(n, peewee.Field) else None)
+                for n in op._select]
+
+    def _row_dict(self, columns, row):
+        return dict((name, conv(value) if conv and value is not None else value)
+                    for (name, conv), value in zip(columns, row))
+
+    def _embedded_fields(self, resource, req):
+        """Relation fields of resource embedded for req, nested (dotted)
+        fields are left to eve
+        """
+        relations = self.relations.get(resource)
+        if not relations or req is None:
+            return []
+        return [f for f in resolve_embedded_fields(resource, req)
+                if f in relations]
+
+    def _link_fields(self, resource, req):
+        """m:m fields of resource that are part of the response for req"""
+        fields = [f for f, (_, link) in self.relations.get(resource, {}).items()
+                  if link is not None]
+        if not fields:
+            return []
+        projection = self.datasource(resource)[2] or {}
+        client = self._client_projection(req) if req else None
+        if client:
+            include = 0 not in client.values()
+            fields = [f for f in fields if client.get(f, not include)]
+        return [f for f in fields if not projection or projection.get(f)]
+
+    def _embed_store(self):
+        """Related documents prefetched for embedding, kept for the request"""
+        if not has_app_context():
+            return {}
+        store = getattr(g, '_eve_peewee_embedded', None)
+        if store is None:
+            store = g._eve_peewee_embedded = {}
+        return store
+
+    def _id_chunks(self, ids):
+        ids = list(ids)
+        size = max(1, self._max_query_params() - 1)
+        return [ids[i:i + size] for i in range(0, len(ids), size)]
+
+    def _join_embedded(self, resource, op, embedded):
+        """LEFT JOINs the related table of each embedded 1:m field to op, the
+        related columns are selected under prefixed aliases. Returns the query
+        and [(field, related resource, [(alias, field name)])].
+        """
+        model = self._get_model_cls(resource)
+        selected = [getattr(n, 'name', None) for n in op._select]
+        columns = list(op._select)
+        joined = []
+        for field in embedded:
+            rel_name, link = self.relations[resource][field]
+            if link is not None or field not in selected:
+                continue
+            rel_model = self.models[rel_name]
+            rel = rel_model.alias()
+            op = op.switch(model).join(
+                rel, peewee.JOIN.LEFT_OUTER,
+                on=(getattr(model, field) == getattr(rel, config.ID_FIELD)))
+            aliases = []
+            for name in rel_model._meta.sorted_field_names:
+                alias = '%s%s__%s' % (self.embed_alias_prefix, field, name)
+                columns.append(getattr(rel, name).alias(alias))
+                aliases.append((alias, name))
+            joined.append((field, rel_name, aliases))
+        if joined:
+            op = op.select(*columns)
+        return op, joined
+
+    def _attach_relations(self, resource, docs, embedded=(), joined=(),
+                          links=()):
+        """Resolves the relations of a batch of documents with a fixed number
+        of queries. Documents joined in by _join_embedded are taken out of
+        their aliased columns, other embedded 1:m fields are read with one
+        IN query and each m:m field in links gets its ids from one query on
+        the link table, joined to the related table when embedded.
+        Related documents go to the request's embed store where find_one
+        picks them up when eve resolves the embedding.
+        """
+        relations = self.relations.get(resource)
+        if not docs or not relations:
+            return
+        related = {}
+
+        for field, rel_name, columns in joined:
+            found = related.setdefault(rel_name, {})
+            for doc in docs:
+                rel_doc = dict((name, doc.pop(alias, None))
+                               for alias, name in columns)
+                if rel_doc.get(config.ID_FIELD) is not None:
+                    found[rel_doc[config.ID_FIELD]] = rel_doc
+
+        joined_fields = set(field for field, _, _ in joined)
+        for field in embedded:
+            rel_name, link = relations[field]
+            if link is not None or field in joined_fields:
+                continue
+            found = related.setdefault(rel_name, {})
+            ids = set(doc[field] for doc in docs
+                      if doc.get(field) is not None) - set(found)
+            rel_model = self.models[rel_name]
+            rel_id = getattr(rel_model, config.ID_FIELD)
+            for chunk in self._id_chunks(ids):
+                for rel_doc in rel_model.select().where(rel_id << chunk).dicts():
+                    found[rel_doc[config.ID_FIELD]] = rel_doc
+
+        ids = [doc[config.ID_FIELD] for doc in docs
+               if doc.get(config.ID_FIELD) is not None]
+        for field in links:
+            rel_name, link = relations[field]
+            lists, rel_docs = self._select_links(resource, field, ids,
+                                                 field in embedded)
+            for doc in docs:
+                doc[field] = lists.get(doc.get(config.ID_FIELD), [])
+            related.setdefault(rel_name, {}).update(rel_docs)
+
+        store = self._embed_store()
+        for rel_name, found in related.items():
+            if found and self.relations.get(rel_name):
+                # the embedded documents' own m:m ids, one level down only
+                self._attach_relations(rel_name, list(found.values()),
+                                       links=self._link_fields(rel_name, None))
+            for id_, rel_doc in found.items():
+                store[(rel_name, id_)] = rel_doc
+
+    def _select_links(self, resource, field, ids, embed=False):
+        """Related ids of m:m field for documents ids as {id: [related ids]}
+        in link order, with {related id: document} when embed
+        """
+        rel_name, link = self.relations[resource][field]
+        link_model = self.link_tables[link]
+        rel_model = self.models[rel_name]
+        parent = getattr(link_model, resource)
+        child = getattr(link_model, rel_name)
+        names = rel_model._meta.sorted_field_names if embed else []
+
+        lists = dict((id_, []) for id_ in ids)
+        related = {}
+        for chunk in self._id_chunks(ids):
+            op = link_model.select(parent, child,
+                                   *[getattr(rel_model, n) for n in names])
+            if embed:
+                op = op.join(rel_model, on=(
+                    child == getattr(rel_model, config.ID_FIELD)))
+            op = op.where(parent << chunk).order_by(link_model._meta.primary_key)
+            for row in op.tuples():
+                lists[row[0]].append(row[1])
+                if embed:
+                    related[row[1]] = dict(zip(names, row[2:]))
+        return lists, related
+
+    def stream(self, resource, req, lookup=None):
+        """Yields every document matching req (where, sort, soft delete) and
+        lookup without pagination, PEEWEE_ITERSIZE rows at a time: from a
+        named cursor on postgres, with fetchmany on other databases.
+        """
+        op = self._find(resource, req, lookup=lookup)
+        size = self.app.config.get('PEEWEE_ITERSIZE', 2000)
+        links = self._link_fields(resource, req)
+        columns = self._row_columns(op)
+        sql, params = op.sql()
+        db = op.database
+        if isinstance(db, peewee.PostgresqlDatabase):
+            cursor = db.get_conn().cursor(name='eve_peewee_%s' % uuid.uuid4().hex)
+            cursor.itersize = size
+            cursor.execute(sql, params)
+        else:
+            cursor = db.execute_sql(sql, params, require_commit=False)
+        try:
+            while True:
+                rows = cursor.fetchmany(size)
+                if not rows:
+                    break
+                docs = [self._row_dict(columns, row) for row in rows]
+                if links:
+                    self._attach_relations(resource, docs, links=links)
+                for doc in docs:
+                    yield doc
+        finally:
+            cursor.close()
+
+    def export(self, resource, req, lookup=None, fmt='ndjson'):
+        """Generator of the serialized collection as newline delimited json
+        documents or as one json array
+        """
+        if fmt not in self.export_formats:
+            raise ValueError("unknown export format '%s'" % fmt)
+        encoder = self.json_encoder_class
+        docs = self.stream(resource, req, lookup)
+        if fmt == 'ndjson':
+            for doc in docs:
+                yield json.dumps(doc, cls=encoder) + '\n'
+        else:
+            yield '['
+            sep = ''
+            for doc in docs:
+                yield sep + json.dumps(doc, cls=encoder)
+                sep = ','
+            yield ']'
+
+    def export_response(self, resource, lookup):
+        """Response for the <resource>/export endpoint registered for resources
+        with `'_peewee': {'export': True}`, ?format=ndjson (default) or json
+        """
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in self.export_formats:
+            abort(400, description='Unknown export format: %s' % fmt)
+        body = self.export(resource, parse_request(resource), lookup, fmt)
+        return Response(stream_with_context(body),
+                        mimetype=self.export_formats[fmt])
+
+    def _register_exports(self, app):
+        prefix = _api_prefix(app)
+        for res_name, v in app.config['DOMAIN'].items():
+            if not (v.get('_peewee') or {}).get('export'):
+                continue
+            url = '/%s/%s/export' % (prefix, v.get('url', res_name))
+
+            def view(_resource=res_name, **lookup):
+                return export_resource(_resource, **lookup)
+            app.add_url_rule(url.replace('//', '/'), '%s|export' % res_name,
+                             view, methods=['GET'])
+
+    def batch(self, operations):
+        """Runs eve writes for a list of operations in one transaction:
+
+        * {'method': 'POST', 'resource': ..., 'payload': doc or [docs]}
+        * {'method': 'PATCH' | 'PUT' | 'DELETE', 'resource': ...,
+          'id': ..., 'payload': doc, 'etag': optional etag to match}
+
+        Documents go through eve's validation, callbacks and etags (the
+        *_internal methods, so without pre-request events), consecutive
+        POSTs to the same resource are inserted together. Returns a
+        (response, status) pair per operation run, the first failing
+        operation ends the batch and rolls all of it back.
+        Needs a request context.
+        """
+        groups = []
+        for op in operations:
+            if groups and op.get('method') == 'POST' and \
+                    groups[-1][0].get('method') == 'POST' and \
+                    groups[-1][0].get('resource') == op.get('resource'):
+                groups[-1].append(op)
+            else:
+                groups.append([op])
+
+        results = []
+        try:
+            with self.driver.atomic():
+                for group in groups:
+                    group_results = self._batch_run(group)
+                    results.extend(group_results)
+                    if any(status >= 400 for _, status in group_results):
+                        raise _BatchAborted()
+        except _BatchAborted:
+            pass
+        # again now that the writes are committed
+        for resource in set(op.get('resource') for op in operations):
+            if resource in self.models:
+                self._invalidate(resource)
+        return results
+
+    def _batch_run(self, group):
+        """Runs a group of batch operations, one result per operation"""
+        try:
+            for op in group:
+                self._batch_check(op)
+            method, resource = group[0]['method'], group[0]['resource']
+
+            if method == 'POST':
+                docs = []
+                for op in group:
+                    payload = op.get('payload')
+                    docs.extend(payload if isinstance(payload, list) else [payload])
+                # eve 0.7 returns a fifth value, index like below
+                result = post_internal(resource, docs)
+                response, status = result[0], result[3]
+                items = response[config.ITEMS] if len(docs) > 1 else [response]
+                results = []
+                for op in group:
+                    if isinstance(op.get('payload'), list):
+                        part, items = items[:len(op['payload'])], items[len(op['payload']):]
+                        ok = all(i.get(config.STATUS) != config.STATUS_ERR
+                                 for i in part)
+                        results.append(({config.STATUS: config.STATUS_OK if ok
+                                         else config.STATUS_ERR,
+                                         config.ITEMS: part}, status))
+                    else:
+                        results.append((items.pop(0), status))
+                return results
+
+            op = group[0]
+            lookup = {config.DOMAIN[resource]['id_field']: op['id']}
+            if op.get('etag') is not None:
+                self._batch_etag_check(resource, op['etag'], lookup)
+            if method == 'PATCH':
+                response = patch_internal(resource, op.get('payload') or {},
+                                          False, False, **lookup)
+            elif method == 'PUT':
+                response = put_internal(resource, op.get('payload') or {},
+                                        False, False, **lookup)
+            else:
+                response = deleteitem_internal(resource, False, **lookup)
+            return [(response[0], response[3])]
+
+        except HTTPException as exc:
+            error = {config.STATUS: config.STATUS_ERR,
+                     config.ERROR: {'code': exc.code, 'message': exc.description}}
+            return [(error, exc.code)] * len(group)
+
+    def _batch_check(self, op):
+        """Aborts unless op is a well formed operation the client may run"""
+        method, resource = op.get('method'), op.get('resource')
+        if method not in self.batch_methods:
+            abort(400, description='Unknown batch method: %s' % method)
+        resource_def = config.DOMAIN.get(resource)
+        if resource_def is None:
+            abort(404, description='Unknown resource: %s' % resource)
+        item = self.batch_methods[method]
+        if item and op.get('id') is None:
+            abort(400, description='%s operations need an id' % method)
+        if method not in resource_def['item_methods' if item else 'resource_methods']:
+            abort(405)
+
+        # same checks as requires_auth for the operation's method
+        if item:
+            public = resource_def['public_item_methods']
+            roles = list(resource_def['allowed_item_roles']) + \
+                resource_def['allowed_item_write_roles']
+        else:
+            public = resource_def['public_methods']
+            roles = list(resource_def['allowed_roles']) + \
+                resource_def['allowed_write_roles']
+        auth = resource_auth(resource)
+        if auth and method not in public and \
+                not auth.authorized(roles, resource, method):
+            auth.authenticate()
+            abort(401)
+
+    def _batch_etag_check(self, resource, etag, lookup):
+        original = get_document(resource, False, **lookup)
+        if not original:
+            return
+        expected = original.get(config.ETAG, document_etag(
+            original, ignore_fields=config.DOMAIN[resource]['etag_ignore_fields']))
+        if etag != expected:
+            abort(412, description="Client and server etags don't match")
+
+    def batch_response(self):
+        """Response for the PEEWEE_BATCH_URL endpoint, the posted body is
+        the list of operations for batch(), at most
+        PEEWEE_BATCH_MAX_OPERATIONS (1000) of them
+        """
+        operations = request.get_json(silent=True)
+        if not isinstance(operations, list) or \
+                not all(isinstance(op, dict) for op in operations):
+            abort(400, description='Expected a list of operations')
+        limit = self.app.config.get('PEEWEE_BATCH_MAX_OPERATIONS', 1000)
+        if len(operations) > limit:
+            abort(400, description='Batch exceeds %d operations' % limit)
+
+        results = self.batch(operations)
+        body = {config.STATUS: config.STATUS_OK,
+                config.ITEMS: [response for response, _ in results]}
+        status = 200
+        failed = [i for i, (response, code) in enumerate(results)
+                  if code >= 400 and
+                  response.get(config.STATUS) == config.STATUS_ERR]
+        if failed:
+            status = results[failed[0]][1]
+            body[config.STATUS] = config.STATUS_ERR
+            body[config.ERROR] = {
+                'code': status,
+                'message': 'Operation %d failed, batch rolled back' % failed[0]}
+        return send_response(None, (body, None, None, status))
+
+    def _register_batch(self, app):
+        url = app.config.get('PEEWEE_BATCH_URL')
+        if not url:
+            return
+        url = '/%s/%s' % (_api_prefix(app), url)
+        app.add_url_rule(url.replace('//', '/'), 'eve_peewee|batch',
+                         batch_operations, methods=['POST'])
 
     def find(self, resource, req, sub_resource_lookup):
+        """Page of documents for a collection GET, from the result cache
+        when the resource has the 'result_cache' option
+        """
+        key = self._result_cache_key(resource, 'find', req, sub_resource_lookup)
+        if key is None:
+            return self._find_page(resource, req, sub_resource_lookup)
+        cached = self.result_cache.get(key)
+        if cached is None:
+            rs = self._find_page(resource, req, sub_resource_lookup)
+            cached = EvePeeweeListResult(
+                list(rs), rs.count(), getattr(rs, 'links', None),
+                getattr(rs, 'meta', None), getattr(rs, '_count_strategy', None))
+            self._cache_result(resource, key, cached)
+        else:
+            cached = copy.deepcopy(cached)
+        return cached
+
+    def _find_page(self, resource, req, sub_resource_lookup):
         try:
-            op = self._find(resource, req, lookup=sub_resource_lookup)
+            op, sort = self._build_find(resource, req, lookup=sub_resource_lookup)
+
+            if req.max_results and \
+                    self._resource_option(resource, 'pagination') == 'keyset':
+                return self._find_keyset(resource, req, op, sort)
 
+            strategy = self._count_strategy(resource, req)
+            page = op
             if req.max_results:
-                op = op.limit(req.max_results)
+                # has_more reads one row past the page to see if there's more
+                page = page.limit(req.max_results +
+                                  (strategy == 'has_more'))
             if req.page > 1:
-                op = op.offset((req.page - 1) * req.max_results)
-
-            rs = op.execute()
-            rs.__class__ = EvePeeweeResultWrapper
-            rs._count = op.count(clear_limit=True)
+                page = page.offset((req.page - 1) * req.max_results)
+            hidden = ()
+            if strategy == 'window':
+                total = peewee.fn.COUNT(peewee.SQL('*')).over()
+                page = page.select(*(list(page._select) +
+                                     [total.alias(self.window_count_alias)]))
+                hidden = (self.window_count_alias,)
+
+            embedded = self._embedded_fields(resource, req)
+            links = self._link_fields(resource, req)
+            page, joined = self._join_embedded(resource, page, embedded)
+            prefetch = None
+            if embedded or links:
+                prefetch = lambda rows: self._attach_relations(
+                    resource, rows, embedded, joined, links)
+
+            page = page.dicts()
+            server_side = not req.max_results and \
+                isinstance(page.database, peewee.PostgresqlDatabase)
+            if server_side:
+                rs = self._execute_server_side(page)
+            else:
+                rs = page.execute()
+            rs = EvePeeweeResultWrapper.adopt(
+                rs, server_side, hidden, prefetch,
+                req.max_results or self.app.config.get('PEEWEE_ITERSIZE', 2000))
+            rs._count, rs._count_strategy = self._count(
+                resource, req, op, strategy, rs)
         except Exception as exc:
             self._handle_exception(exc)
 
         return rs
 
+    def _execute_server_side(self, op):
+        """Executes a select on a named postgres cursor so rows are streamed
+        from the server PEEWEE_ITERSIZE at a time instead of being loaded
+        into the client at once
+        """
+        sql, params = op.sql()
+        cursor = op.database.get_conn().cursor(
+            name='eve_peewee_%s' % uuid.uuid4().hex)
+        cursor.itersize = self.app.config.get('PEEWEE_ITERSIZE', 2000)
+        cursor.execute(sql, params)
+        ResultWrapper = op._get_result_wrapper()
+        return ResultWrapper(op.model_class, cursor, op.get_query_meta())
+
+    def _count_strategy(self, resource, req):
+        strategy = self._resource_option(resource, 'count', 'exact')
+        if strategy not in self.count_strategies:
+            raise ValueError("unknown count strategy '%s'" % strategy)
+        if strategy == 'has_more' and not req.max_results:
+            return 'exact'
+        return strategy
+
+    def _count(self, resource, req, op, strategy, rs=None):
+        """Total for the collection, returns (count, strategy used).
+        Configured with `'_peewee': {'count': ...}` or PEEWEE_COUNT:
+
+        * exact: separate SELECT COUNT(*) with the same where clause
+        * window: COUNT(*) OVER() read from the first row of the page,
+          needs window function support (sqlite 3.25+)
+        * estimate: planner row estimate on postgres, exact when below
+          PEEWEE_COUNT_ESTIMATE_THRESHOLD or on other databases
+        * has_more: no count, page is fetched with one extra row and the
+          total is reported as a lower bound
+        * cached: exact count cached for PEEWEE_COUNT_CACHE_TTL seconds
+          per resource and where clause
+        """
+        offset = 0
+        if req.max_results and req.page > 1:
+            offset = (req.page - 1) * req.max_results
+
+        if strategy == 'window' and rs is not None:
+            rows = rs.read_ahead(1)
+            if rows:
+                return rows[0][self.window_count_alias], strategy
+            elif not offset:
+                return 0, strategy
+            # past the last page there's no row to read the total from
+
+        elif strategy == 'has_more' and rs is not None:
+            rows = rs.read_ahead(req.max_results + 1)
+            fetched = len(rows)
+            if fetched > req.max_results:
+                rows.pop()
+            return offset + fetched, strategy
+
+        elif strategy == 'estimate':
+            threshold = self.app.config.get('PEEWEE_COUNT_ESTIMATE_THRESHOLD', 1000)
+            estimate = self._estimate_count(op)
+            if estimate is not None and estimate >= threshold:
+                return estimate, strategy
+
+        elif strategy == 'cached':
+            sql, params = op.order_by().sql()
+            key = (resource, sql, repr(params))
+            count = self._count_cache.get(key)
+            if count is None:
+                count = op.count(clear_limit=True)
+                self._count_cache.set(key, count)
+            return count, strategy
+
+        return op.count(clear_limit=True), 'exact'
+
+    def _estimate_count(self, op):
+        """Planner estimate for the number of rows op returns, None if the
+        database doesn't provide one
+        """
+        db = op.database
+        if not isinstance(db, peewee.PostgresqlDatabase):
+            return None
+        meta = op.model_class._meta
+        if op._where is None:
+            table = meta.db_table
+            if getattr(meta, 'schema', None):
+                table = '%s.%s' % (meta.schema, table)
+            row = db.execute_sql(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                (table,)).fetchone()
+            if row and row[0] >= 0:
+                return int(row[0])
+            return None
+        sql, params = op.order_by().sql()
+        plan = db.execute_sql('EXPLAIN (FORMAT JSON) ' + sql, params).fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def _keyset_predicate(self, keys, values, forward):
+        """Rows strictly after values in (field, ascending) key order,
+        or strictly before them when going backwards
+        """
+        def seek(asc):
+            return operator.gt if asc == forward else operator.lt
+
+        if len(set(asc for _, asc in keys)) == 1:
+            # uniform direction: row value comparison is a single range seek
+            lhs = peewee.EnclosedClause(*[f for f, _ in keys])
+            rhs = peewee.EnclosedClause(
+                *[peewee.Param(f.db_value(v)) for (f, _), v in zip(keys, values)])
+            return seek(keys[0][1])(lhs, rhs)
+
+        clauses = []
+        for i, (field, asc) in enumerate(keys):
+            terms = [keys[j][0] == values[j] for j in range(i)]
+            terms.append(seek(asc)(field, values[i]))
+            clauses.append(reduce(operator.and_, terms))
+        return reduce(operator.or_, clauses)
+
+    def _find_keyset(self, resource, req, op, sort):
+        """Keyset (seek) pagination, enabled per resource with
+        `'_peewee': {'pagination': 'keyset'}`. Pages are addressed with an
+        opaque cursor built from the active sort plus ID_FIELD instead of
+        page numbers, so every page is an indexed range scan.
+        Sort fields are expected to be non-null.
+        """
+        model = self._get_model_cls(resource)
+        keys = list(sort)
+        if config.ID_FIELD not in [f.name for f, _ in keys]:
+            keys.append((getattr(model, config.ID_FIELD), True))
+        signature = [('' if asc else '-') + f.name for f, asc in keys]
+        strategy = self._count_strategy(resource, req)
+        if strategy not in ('window', 'has_more'):
+            count, strategy = self._count(resource, req, op, strategy)
+
+        forward = True
+        token = request.args.get(self.cursor_arg)
+        if token:
+            try:
+                direction, token_sig, raw = decode_cursor(token)
+                if token_sig != signature or len(raw) != len(keys):
+                    raise ValueError(token)
+                values = [f.python_value(v) for (f, _), v in zip(keys, raw)]
+            except Exception:
+                abort(400, description='Invalid cursor')
+            forward = direction == 'next'
+            op = op.where(self._keyset_predicate(keys, values, forward))
+        elif req.page > 1:
+            # plain page numbers still work, they just don't seek
+            op = op.offset((req.page - 1) * req.max_results)
+
+        # key fields have to be selected even if projected out
+        selected = set(getattr(n, 'name', None) for n in op._select)
+        hidden = [f for f, _ in keys if f.name not in selected]
+        if hidden:
+            op = op.select(*(list(op._select) + hidden))
+        embedded = self._embedded_fields(resource, req)
+        op, joined = self._join_embedded(resource, op, embedded)
+
+        op = op.order_by(*[f if asc == forward else f.desc() for f, asc in keys])
+        rows = list(op.limit(req.max_results + 1).dicts())
+        more = len(rows) > req.max_results
+        del rows[req.max_results:]
+        if not forward:
+            rows.reverse()
+
+        def cursor(direction, row):
+            return encode_cursor(direction, signature,
+                                 [row[f.name] for f, _ in keys])
+
+        next_token = prev_token = None
+        if rows:
+            if more or not forward:
+                next_token = cursor('next', rows[-1])
+            if (more and not forward) or \
+                    (forward and (token or req.page > 1)):
+                prev_token = cursor('prev', rows[0])
+        for row in rows:
+            for f in hidden:
+                row.pop(f.name, None)
+            _decode_json(_drop_null_etag(row))
+        self._attach_relations(resource, rows, embedded, joined,
+                               self._link_fields(resource, req))
+        if strategy in ('window', 'has_more'):
+            # the page was read with one extra row already
+            strategy = 'has_more'
+            count = len(rows) + more
+
+        links = {}
+        if next_token:
+            links['next'] = {'title': 'next page', 'href':
+                             _resource_href(page=None, **{self.cursor_arg: next_token})}
+        if prev_token:
+            links['prev'] = {'title': 'previous page', 'href':
+                             _resource_href(page=None, **{self.cursor_arg: prev_token})}
+        meta = {'cursor': {'next': next_token, 'prev': prev_token}}
+        return EvePeeweeListResult(rows, count, links=links, meta=meta,
+                                   count_strategy=strategy)
+
 
     def insert(self, resource, doc_or_docs):
         """Called when performing POST request"""
+        self._record_write()
         if not isinstance(doc_or_docs, list):
             doc_or_docs = [doc_or_docs]
         ids = []
 
         try:
-            for doc in doc_or_docs:
-                model = self._doc_to_model(resource, doc)
-                model.save(force_insert=True)
-                id = getattr(model, config.ID_FIELD)
-                ids.append(id)
-                # TODO: query the stored data in case triggers change it?
-                doc[config.ID_FIELD] = id
+            with self.driver.atomic():
+                if len(doc_or_docs) > 1:
+                    ids = self._bulk_insert(resource, doc_or_docs)
+                    for doc, id in zip(doc_or_docs, ids):
+                        doc[config.ID_FIELD] = id
+                else:
+                    for doc in doc_or_docs:
+                        model = self._doc_to_model(resource, doc)
+                        model.save(force_insert=True)
+                        id = getattr(model, config.ID_FIELD)
+                        ids.append(id)
+                        # TODO: query the stored data in case triggers change it?
+                        doc[config.ID_FIELD] = id
+                self._save_links(resource, doc_or_docs)
+            self._invalidate(resource)
             return ids
 
         except Exception as exc:
             self._handle_exception(exc)
 
 
+    def _max_query_params(self):
+        for db_cls, limit in self.max_query_params:
+            if isinstance(self.driver, db_cls):
+                return limit
+        return 999
+
+    def _bulk_insert(self, resource, docs):
+        """Multi-row INSERTs chunked to the backend's parameter limit in one
+        transaction. Returns the new ids in document order: from RETURNING on
+        postgres, from the last rowid on sqlite (rowids of a single statement
+        are consecutive), row by row elsewhere.
+        """
+        cls = self._get_model_cls(resource)
+        pk = cls._meta.primary_key.name
+        rows = [self._doc_to_model(resource, doc)._data for doc in docs]
+
+        explicit = [row.get(pk) is not None for row in rows]
+        if any(explicit) and not all(explicit):
+            # can't mix NULL and given keys in one statement on every backend
+            chunks, columns = [[row] for row in rows], None
+        else:
+            columns = set()
+            for row in rows:
+                columns.update(row)
+            if not all(explicit):
+                columns.discard(pk)
+            rows = [dict((c, row.get(c)) for c in columns) for row in rows]
+            size = max(1, self._max_query_params() // max(1, len(columns)))
+            chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+
+        ids = []
+        with self.driver.atomic():
+            for chunk in chunks:
+                if all(explicit):
+                    cls.insert_many(chunk).execute()
+                    ids.extend(row[pk] for row in chunk)
+                elif columns is None or len(chunk) == 1:
+                    for row in chunk:
+                        id = cls.insert(**row).execute()
+                        ids.append(row[pk] if row.get(pk) is not None else id)
+                elif self.driver.returning_clause:
+                    ids.extend(cls.insert_many(chunk).return_id_list().execute())
+                elif isinstance(self.driver, peewee.SqliteDatabase):
+                    # execute() only returns True for multi-row inserts
+                    cursor = cls.insert_many(chunk)._execute()
+                    last = self.driver.last_insert_id(cursor, cls)
+                    ids.extend(range(last - len(chunk) + 1, last + 1))
+                else:
+                    for row in chunk:
+                        ids.append(cls.insert(**row).execute())
+        return ids
+
+    def _save_links(self, resource, docs, originals=None):
+        """Writes the m:m fields of stored docs to the link tables: one
+        insert_many (chunked to the parameter limit) for all new links and
+        one DELETE per document for removed ones. Links are diffed against
+        the matching document in originals, new documents have none.
+        m:m fields missing from a document are left as they are.
+        Runs in the caller's transaction.
+        """
+        relations = self.relations.get(resource) or {}
+        now = datetime.utcnow()
+        for field, (rel_name, link) in relations.items():
+            if link is None:
+                continue
+            link_model = self.link_tables[link]
+            parent = getattr(link_model, resource)
+            child = getattr(link_model, rel_name)
+
+            rows = []
+            for i, doc in enumerate(docs):
+                if field not in doc:
+                    continue
+                id_ = doc[config.ID_FIELD]
+                seen = set()
+                new = [r for r in doc[field] or []
+                       if not (r in seen or seen.add(r))]
+                old = set()
+                original = originals[i] if originals else None
+                if original is not None:
+                    if field in original:
+                        old = set(original[field] or [])
+                    else:
+                        old = set(self._select_links(resource, field, [id_])[0][id_])
+
+                removed = old.difference(new)
+                for chunk in self._id_chunks(removed):
+                    link_model.delete().where(
+                        (parent == id_) & (child << chunk)).execute()
+                rows.extend({resource: id_, rel_name: r,
+                             '_created': now, '_updated': now}
+                            for r in new if r not in old)
+
+            # every column of the link table may be bound
+            size = max(1, self._max_query_params() // len(link_model._meta.fields))
+            for i in range(0, len(rows), size):
+                link_model.insert_many(rows[i:i + size]).execute()
+
     def update(self, resource, id_, updates, original):
-        """Called when performing PATCH request."""
+        """Called when performing PATCH request.
+        Writes only the changed columns in a single UPDATE. The row must
+        still carry the LAST_UPDATED of `original`, otherwise it was changed
+        after eve's etag check and the request fails with 412. With the
+        'returning' option on postgres the stored row is merged back into
+        `updates`. m:m fields are written with _save_links in the same
+        transaction.
+        """
+        self._record_write()
         cls = self._get_model_cls(resource)
 
-        model = cls.get(getattr(cls, config.ID_FIELD) == id_)
-        model._updated = datetime.utcnow()
+        values = {'_updated': datetime.utcnow()}
+        values.update((k, v) for k, v in updates.items()
+                      if k in cls._meta.fields)
+        op = cls.update(**values).where(getattr(cls, config.ID_FIELD) == id_)
+        guard = self._unchanged_since(cls, original)
+        if guard is not None:
+            op = op.where(guard)
 
-        for k,v in updates.items():
-            setattr(model, k, v)
+        returning = self.driver.returning_clause and \
+            self._resource_option(resource, 'returning', False)
+        if returning:
+            op = op.returning().dicts()
 
         try:
-            model.save()
+            with self.driver.atomic():
+                if returning:
+                    rows = list(op.execute())
+                    if rows:
+                        updates.update(rows[0])
+                    count = len(rows)
+                else:
+                    count = op.execute()
+                if count:
+                    doc = dict(updates)
+                    doc[config.ID_FIELD] = id_
+                    self._save_links(resource, [doc], [original])
         except Exception as exc:
             self._handle_exception(exc)
+        self._invalidate(resource)
+
+        if not count:
+            if cls.select().where(getattr(cls, config.ID_FIELD) == id_).exists():
+                abort(412, description='Document was modified concurrently')
+            abort(404)
+
+    def _unchanged_since(self, cls, original):
+        """Concurrency guard for writes based on the fetched original"""
+        if not original or config.LAST_UPDATED not in original:
+            return None
+        last = original[config.LAST_UPDATED]
+        if last is None:
+            return cls._updated >> None
+        if last == datetime(1970, 1, 1):
+            # eve's stand-in for documents created outside the API
+            return (cls._updated >> None) | (cls._updated == last)
+        return cls._updated == last
 
 
     def replace(self, resource, id_, document, original):
         """Called when performing PUT request."""
+        self._record_write()
         cls = self._get_model_cls(resource)
         model = self._doc_to_model(resource, document)
         setattr(model, config.ID_FIELD, id_)
 
+        doc = dict(document)
+        doc[config.ID_FIELD] = id_
+        # m:m fields left out of a replacement are emptied
+        for field, (_, link) in self.relations.get(resource, {}).items():
+            if link is not None:
+                doc.setdefault(field, [])
+
         try:
-            model.save()
+            with self.driver.atomic():
+                model.save()
+                self._save_links(resource, [doc], [original])
         except Exception as exc:
             self._handle_exception(exc)
+        self._invalidate(resource)
 
 
     def remove(self, resource, lookup):
-        """Called when performing DELETE request."""
+        """Called when performing DELETE request.
+        Documents of soft_delete resources are only marked deleted, with one
+        UPDATE, see _soft_delete.
+        """
         cls = self._get_model_cls(resource)
 
+        if config.DOMAIN[resource]['soft_delete']:
+            # _soft_delete records the write
+            op = self._parse_where(self._soft_delete_query(cls), lookup)
+            return self._soft_delete(resource, op)
+
+        self._record_write()
         op = cls.delete()
         op = self._parse_where(op, lookup)
 
         try:
-            op.execute()
+            with self.driver.atomic():
+                self._remove_links(resource, lookup)
+                op.execute()
+        except Exception as exc:
+            self._handle_exception(exc)
+        self._invalidate(resource)
+
+    def _soft_delete_query(self, cls):
+        return cls.update(_deleted=True, _updated=datetime.utcnow()) \
+            .where(cls._deleted == False)
+
+    def _soft_delete(self, resource, op):
+        """Executes op, an UPDATE marking documents deleted. With the
+        'returning' option on postgres the ids of the documents deleted are
+        returned, the number of them otherwise.
+        """
+        self._record_write()
+        cls = self._get_model_cls(resource)
+        returning = self.driver.returning_clause and \
+            self._resource_option(resource, 'returning', False)
+        try:
+            if returning:
+                op = op.returning(getattr(cls, config.ID_FIELD)).tuples()
+                result = [row[0] for row in op.execute()]
+            else:
+                result = op.execute()
+        except Exception as exc:
+            self._handle_exception(exc)
+        self._invalidate(resource)
+        return result
+
+    def _on_delete_resource(self, resource):
+        """on_delete_resource hook, soft deletes what a collection DELETE
+        matches with one UPDATE before eve would mark the documents one
+        at a time. Left to eve for versioned resources and with the oplog on
+        as those record every document.
+        """
+        resource_def = config.DOMAIN[resource]
+        if not resource_def['soft_delete'] or resource_def['versioning'] or \
+                config.OPLOG:
+            return
+        cls = self._get_model_cls(resource)
+        id_field = getattr(cls, config.ID_FIELD)
+        # the documents eve's own find would return for the collection
+        ids = self._find(resource, ParsedRequest(),
+                         lookup=dict(request.view_args or {}))
+        ids = ids.select(id_field).order_by()
+        self._soft_delete(resource,
+                          self._soft_delete_query(cls).where(id_field << ids))
+
+    def _remove_links(self, resource, lookup):
+        """Deletes link table rows of the documents matching lookup, on
+        either side of the relation
+        """
+        cls = self._get_model_cls(resource)
+        ids = None
+        for link_model in self.link_tables.values():
+            if resource not in link_model._meta.fields:
+                continue
+            if ids is None:
+                ids = self._parse_where(
+                    cls.select(getattr(cls, config.ID_FIELD)), lookup)
+            link_model.delete().where(
+                getattr(link_model, resource) << ids).execute()
+
+
+    def aggregate(self, resource, pipeline, options=None):
+        """Runs an aggregation pipeline as a single SELECT: $match (WHERE, or
+        HAVING on the outputs when it follows $group), one $group with
+        $sum/$avg/$min/$max/$count accumulators, $sort, $skip and $limit, in
+        that order. Field references are '$field', no nested paths.
+        Documents are filtered like find does (soft delete, datasource
+        filter), options are ignored.
+        """
+        cls = self._get_model_cls(resource)
+        op = self._find(resource, ParsedRequest()).order_by()
+
+        # output name -> (expression, python_value)
+        outputs = None
+        position = 0
+        for stage in pipeline:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                abort(400, description='Aggregation stages have one operator')
+            name, spec = list(stage.items())[0]
+            if name == '$match' and outputs is not None:
+                name = '$having'
+            if name not in self.aggregate_stages or \
+                    self.aggregate_stages.index(name) < position:
+                abort(400, description='Unsupported aggregation stage: %s'
+                      % stage)
+            position = self.aggregate_stages.index(name) + 1
+
+            # an empty $match matches everything, where() needs a term
+            if name == '$match':
+                terms = self._match_terms(
+                    spec, lambda key: self._field_ref(cls, '$' + key))
+                if terms:
+                    op = op.where(*terms)
+            elif name == '$group':
+                outputs, group_by = self._group_outputs(cls, spec)
+                op = op.select(*[e for e, _ in outputs.values()])
+                if group_by:
+                    op = op.group_by(*group_by)
+            elif name == '$having':
+                terms = self._match_terms(
+                    spec, lambda key: self._output_ref(outputs, key))
+                if terms:
+                    op = op.having(*terms)
+            elif name == '$sort':
+                resolve = (lambda key: self._field_ref(cls, '$' + key)) \
+                    if outputs is None else \
+                    (lambda key: self._output_ref(outputs, key))
+                op = op.order_by(*self._sort_terms(spec, resolve))
+            elif name == '$skip':
+                op = op.offset(self._stage_count(name, spec))
+            elif name == '$limit':
+                op = op.limit(self._stage_count(name, spec))
+
+        try:
+            if outputs is None:
+                docs = [_decode_json(doc) for doc in op.dicts()]
+            else:
+                sql, params = op.sql()
+                cursor = op.database.execute_sql(sql, params,
+                                                 require_commit=False)
+                columns = [(name, conv) for name, (_, conv) in outputs.items()]
+                docs = [self._group_document(self._row_dict(columns, row))
+                        for row in cursor.fetchall()]
         except Exception as exc:
             self._handle_exception(exc)
+        return EvePeeweeListResult(docs, len(docs))
+
+    def _field_ref(self, cls, ref):
+        if not hasattr(ref, 'startswith') or not ref.startswith('$') or \
+                ref[1:] not in cls._meta.fields:
+            abort(400, description='Unknown field in aggregation: %s' % (ref,))
+        return getattr(cls, ref[1:])
+
+    def _output_ref(self, outputs, key):
+        if key not in outputs:
+            abort(400, description='Unknown field in aggregation: %s' % key)
+        return outputs[key][0]
+
+    def _match_terms(self, spec, resolve):
+        """Expressions for a $match document, {key: value} or {key: {$op:
+        value}} with the operators of match_operators
+        """
+        if not isinstance(spec, dict):
+            abort(400, description='$match takes a document')
+        terms = []
+        for key, value in spec.items():
+            node = resolve(key)
+            if isinstance(value, dict) and value and \
+                    all(k.startswith('$') for k in value):
+                for name, arg in value.items():
+                    if name not in self.match_operators:
+                        abort(400, description='Unsupported operator: %s' % name)
+                    terms.append(self.match_operators[name](node, arg))
+            else:
+                terms.append(node == value)
+        return terms
 
+    def _sort_terms(self, spec, resolve):
+        """ORDER BY terms of a $sort stage, {key: 1 | -1} or a list of
+        [key, 1 | -1] pairs
+        """
+        if isinstance(spec, dict):
+            items = list(spec.items())
+        elif isinstance(spec, list) and \
+                all(isinstance(i, (list, tuple)) and len(i) == 2
+                    for i in spec):
+            items = spec
+        else:
+            abort(400, description='$sort takes a document of key: 1 | -1')
+        terms = []
+        for key, direction in items:
+            if not hasattr(key, 'startswith'):
+                abort(400, description='Invalid $sort key: %s' % (key,))
+            if isinstance(direction, bool) or direction not in (1, -1):
+                abort(400, description='$sort direction of %s is 1 or -1'
+                      % key)
+            node = resolve(key)
+            terms.append(node if direction == 1 else node.desc())
+        return terms
+
+    def _stage_count(self, name, spec):
+        """Argument of $skip and $limit, a non-negative integer"""
+        if isinstance(spec, bool) or not isinstance(spec, int) or spec < 0:
+            abort(400, description='%s takes a non-negative integer' % name)
+        return spec
+
+    def _group_outputs(self, cls, spec):
+        """(outputs, group_by) of a $group stage, outputs keyed by name with
+        the group keys as '_id' or '_id.<key>' for a compound _id
+        """
+        if not isinstance(spec, dict) or '_id' not in spec:
+            abort(400, description='$group needs an _id')
+        outputs = OrderedDict()
+        group_by = []
+        id_spec = spec['_id']
+        if isinstance(id_spec, dict):
+            keys = [('_id.' + k, ref) for k, ref in sorted(id_spec.items())]
+        elif id_spec is None:
+            keys = []
+        else:
+            keys = [('_id', id_spec)]
+        for name, ref in keys:
+            field = self._field_ref(cls, ref)
+            group_by.append(field)
+            outputs[name] = (field, field.python_value)
+
+        for name, accumulator in sorted(spec.items()):
+            if name == '_id':
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                abort(400, description='Unsupported accumulator: %s' % name)
+            function, arg = list(accumulator.items())[0]
+            conv = None
+            if function == '$count' or (function == '$sum' and
+                                        isinstance(arg, (int, float)) and
+                                        not isinstance(arg, bool)):
+                # {$sum: 1} counts documents, like {$count: {}}
+                expr = peewee.fn.COUNT(peewee.SQL('*'))
+                if function == '$sum' and arg != 1:
+                    expr = expr * arg
+            elif function in self.aggregate_functions:
+                field = self._field_ref(cls, arg)
+                expr = getattr(peewee.fn, self.aggregate_functions[function])(field)
+                if function in ('$min', '$max'):
+                    conv = field.python_value
+            else:
+                abort(400, description='Unsupported accumulator: %s' % function)
+            outputs[name] = (expr, conv)
+        return outputs, group_by
+
+    def _group_document(self, row):
+        doc = {'_id': row.pop('_id', None)}
+        for name in [n for n in row if n.startswith('_id.')]:
+            if not isinstance(doc['_id'], dict):
+                doc['_id'] = {}
+            doc['_id'][name[4:]] = row.pop(name)
+        doc.update(row)
+        return doc
 
     def __getattr__(cls, attr):
         """placeholder for unimplemented methods"""
@@ -0,0 +1,129 @@
+"""asyncio variant of the data layer.
+
+Eve itself is synchronous, so AsyncEvePeewee keeps every EvePeewee method
+and adds coroutine counterparts of the reads for code running on an event
+loop. Queries are built by the same _build_find and _parse_where and
+executed through aiosqlite or asyncpg, so one process keeps many of them in
+flight instead of blocking a thread per query. The coroutines read eve's
+config and so run inside an app context. Relations aren't embedded.
+
+    data = app.data  # Eve(data=AsyncEvePeewee)
+    with app.app_context():
+        await data.connect()
+        docs = await data.find_async('people', ParsedRequest())
+"""
+import itertools
+import re
+
+from playhouse import db_url
+
+from . import EvePeewee
+
+_PLACEHOLDER = re.compile(r'%([s%])')
+
+
+def _numbered(sql):
+    """psycopg2 placeholders (%s) to asyncpg's ($1, $2, ...)"""
+    counter = itertools.count(1)
+    return _PLACEHOLDER.sub(
+        lambda m: '%' if m.group(1) == '%' else '$%d' % next(counter), sql)
+
+
+class SqliteExecutor(object):
+    """A single aiosqlite connection, sqlite runs one statement at a time"""
+    def __init__(self, database, **options):
+        self.database = database
+        self._conn = None
+
+    async def connect(self):
+        import aiosqlite
+        self._conn = await aiosqlite.connect(self.database)
+
+    async def fetch(self, sql, params):
+        async with self._conn.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+    async def close(self):
+        await self._conn.close()
+
+
+class PostgresExecutor(object):
+    """asyncpg connection pool of up to max_connections"""
+    connect_args = ('host', 'port', 'user', 'password')
+
+    def __init__(self, database, max_connections=20, **options):
+        self.database = database
+        self.max_connections = max_connections
+        self.options = dict((k, v) for k, v in options.items()
+                            if k in self.connect_args)
+        self._pool = None
+
+    async def connect(self):
+        import asyncpg
+        self._pool = await asyncpg.create_pool(
+            database=self.database, min_size=1, max_size=self.max_connections,
+            **self.options)
+
+    async def fetch(self, sql, params):
+        return await self._pool.fetch(_numbered(sql), *params)
+
+    async def close(self):
+        await self._pool.close()
+
+
+class AsyncEvePeewee(EvePeewee):
+    """EvePeewee with find_async, find_one_async and count_async executed by
+    an async driver for DATABASE_ASYNC_URI (DATABASE_URI by default)
+    """
+    executors = {
+        'sqlite': SqliteExecutor,
+        'postgres': PostgresExecutor,
+        'postgresql': PostgresExecutor,
+        'postgresext': PostgresExecutor,
+    }
+
+    def init_app(self, app):
+        super(AsyncEvePeewee, self).init_app(app)
+        uri = app.config.get('DATABASE_ASYNC_URI') or app.config['DATABASE_URI']
+        self.executor = self._get_executor(uri, app.config)
+
+    def _get_executor(self, uri, app_config):
+        scheme = db_url.urlparse(uri).scheme.split('+')[0]
+        if scheme not in self.executors:
+            raise ValueError('no async driver for %s' % scheme)
+        return self.executors[scheme](
+            max_connections=app_config.get('DATABASE_POOL_MAX_CONNECTIONS', 20),
+            **db_url.parse(uri))
+
+    async def connect(self):
+        await self.executor.connect()
+
+    async def close(self):
+        await self.executor.close()
+
+    async def _fetch_dicts(self, op):
+        sql, params = op.sql()
+        rows = await self.executor.fetch(sql, params)
+        columns = self._row_columns(op)
+        return [self._row_dict(columns, row) for row in rows]
+
+    async def find_async(self, resource, req, sub_resource_lookup=None):
+        """Documents of req's page, as a list"""
+        op = self._find(resource, req, lookup=sub_resource_lookup)
+        if req.max_results:
+            op = op.limit(req.max_results)
+        if req.page > 1:
+            op = op.offset((req.page - 1) * req.max_results)
+        return await self._fetch_dicts(op)
+
+    async def find_one_async(self, resource, req, **lookup):
+        docs = await self._fetch_dicts(
+            self._find(resource, req, lookup=lookup).limit(1))
+        return docs[0] if docs else None
+
+    async def count_async(self, resource, req, sub_resource_lookup=None):
+        sql, params = self._find(resource, req, lookup=sub_resource_lookup) \
+            .order_by().sql()
+        rows = await self.executor.fetch(
+            'SELECT COUNT(*) FROM (%s) AS _count' % sql, params)
+        return rows[0][0]
@@ -0,0 +1,114 @@
+"""Storage of dict and list fields on databases without jsonb.
+
+Values are kept as compact JSON text, which sqlite's JSON1 functions can
+filter on, or as msgpack blobs, smaller and quicker to decode but opaque
+to SQL. Values read back are wrapped in LazyJSON and only decoded when
+they're used. Documents are decoded before the data layer hands them to
+eve, PeeweeJSONEncoder renders the values of model instances.
+"""
+import copy
+import json
+
+import peewee
+
+_UNDECODED = object()
+
+
+class LazyJSON(object):
+    """Stored value decoded on first use, reads go to the decoded value"""
+    __slots__ = ('raw', 'loads', '_value')
+
+    def __init__(self, raw, loads):
+        self.raw = raw
+        self.loads = loads
+        self._value = _UNDECODED
+
+    @property
+    def value(self):
+        if self._value is _UNDECODED:
+            self._value = self.loads(self.raw)
+        return self._value
+
+    def __getattr__(self, name):
+        # dict/list methods: get, items, append, ...
+        return getattr(self.value, name)
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __setitem__(self, key, item):
+        self.value[key] = item
+
+    def __contains__(self, key):
+        return key in self.value
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyJSON):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __copy__(self):
+        return copy.copy(self.value)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.value, memo)
+
+    def __repr__(self):
+        return 'LazyJSON(%r)' % (self.value,)
+
+
+def decoded(value):
+    """The plain value of a LazyJSON, other values as they are"""
+    return value.value if isinstance(value, LazyJSON) else value
+
+
+class JSONTextField(peewee.TextField):
+    """dict/list as compact JSON text. Other values, like the pattern of a
+    contains() lookup, are passed through as text.
+    """
+    def db_value(self, value):
+        if isinstance(value, LazyJSON) and value._value is _UNDECODED:
+            return value.raw
+        if not isinstance(value, (dict, list, LazyJSON)):
+            return super(JSONTextField, self).db_value(value)
+        return json.dumps(decoded(value), separators=(',', ':'),
+                          ensure_ascii=False)
+
+    def python_value(self, value):
+        if value is None or isinstance(value, LazyJSON):
+            return value
+        return LazyJSON(value, json.loads)
+
+
+def _unpack(raw):
+    import msgpack
+    return msgpack.unpackb(bytes(raw), raw=False)
+
+
+class MsgpackField(peewee.BlobField):
+    """dict/list as msgpack, needs the msgpack package"""
+    def db_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, LazyJSON) and value._value is _UNDECODED:
+            packed = bytes(value.raw)
+        else:
+            import msgpack
+            packed = msgpack.packb(decoded(value), use_bin_type=True)
+        return super(MsgpackField, self).db_value(packed)
+
+    def python_value(self, value):
+        if value is None or isinstance(value, LazyJSON):
+            return value
+        return LazyJSON(value, _unpack)
@@ -0,0 +1,221 @@
+"""Schema migrations planned by comparing the models generated from DOMAIN
+with the live database.
+
+Missing tables are created, missing columns added and nullability adjusted
+through playhouse.migrate, missing indexes are built with CREATE INDEX
+CONCURRENTLY on postgres so writes aren't blocked while they build.
+Changes that could lose data or need a value for existing rows (dropping
+columns, adding NOT NULL columns without a default) are only reported.
+Column types aren't compared.
+
+A fingerprint of the generated DDL can be kept in the database so workers
+booting against an up to date schema skip all of the above with one query.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import logging
+
+import peewee
+from playhouse.migrate import SchemaMigrator
+
+from .schema import model_indexes, missing_indexes, index_sql
+
+logger = logging.getLogger(__name__)
+
+
+#: run is None for changes that are only reported
+Operation = namedtuple('Operation', 'description run')
+
+#: table holding the fingerprint of the schema last set up
+FINGERPRINT_TABLE = 'eve_peewee_schema'
+
+# advisory lock key shared by the workers on postgres
+LOCK_KEY = 0x65766570
+
+
+def create_index(database, spec):
+    """Creates an index, concurrently on postgres (which can't be done in a
+    transaction block, so the connection is switched to autocommit)
+    """
+    if not isinstance(database, peewee.PostgresqlDatabase):
+        database.execute_sql(index_sql(database, spec))
+        return
+    conn = database.get_conn()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(index_sql(database, spec, concurrently=True))
+    finally:
+        conn.autocommit = autocommit
+
+
+def plan_migration(models, database, index_specs=()):
+    """Operations bringing the database in line with models, followed by
+    index_specs (see eve_peewee.schema.plan_indexes)
+    """
+    migrator = SchemaMigrator.from_database(database)
+    tables = set(database.get_tables())
+    operations = []
+    indexes = list(index_specs)
+
+    # referenced tables first
+    for model in peewee.sort_models_topologically(models):
+        meta = model._meta
+        table = meta.db_table
+        if table not in tables:
+            # indexes of the model come with the table
+            operations.append(Operation('create table %s' % table,
+                                        lambda model=model: model.create_table()))
+            continue
+        indexes = model_indexes(model) + indexes
+
+        columns = dict((c.name, c) for c in database.get_columns(table))
+        for field in meta.sorted_fields:
+            column = columns.pop(field.db_column, None)
+            name = '%s.%s' % (table, field.db_column)
+            if field.primary_key:
+                continue
+            if column is None:
+                if not field.null and field.default is None:
+                    operations.append(Operation(
+                        'add column %s: NOT NULL without a default' % name, None))
+                else:
+                    operations.append(Operation(
+                        'add column %s' % name,
+                        migrator.add_column(table, field.db_column, field).run))
+            elif column.null and not field.null:
+                operations.append(Operation(
+                    'set %s NOT NULL' % name,
+                    migrator.add_not_null(table, field.db_column).run))
+            elif field.null and not column.null:
+                operations.append(Operation(
+                    'drop NOT NULL of %s' % name,
+                    migrator.drop_not_null(table, field.db_column).run))
+        for column in sorted(columns):
+            operations.append(Operation(
+                'column %s.%s is not in the schema' % (table, column), None))
+
+    for spec in missing_indexes(database, indexes):
+        operations.append(Operation(
+            index_sql(database, spec,
+                      isinstance(database, peewee.PostgresqlDatabase)),
+            lambda spec=spec: create_index(database, spec)))
+    return operations
+
+
+def add_missing_columns(models, database, names):
+    """Adds the columns in names to the existing tables of models lacking
+    them, e.g. tables created by an older version. The fields have to be
+    nullable or have a default. Returns the columns added.
+    """
+    migrator = SchemaMigrator.from_database(database)
+    tables = set(database.get_tables())
+    added = []
+    for model in models:
+        table = model._meta.db_table
+        if table not in tables:
+            continue
+        columns = set(c.name for c in database.get_columns(table))
+        for name in names:
+            field = model._meta.fields.get(name)
+            if field is None or field.db_column in columns:
+                continue
+            logger.info('adding column %s.%s', table, field.db_column)
+            migrator.add_column(table, field.db_column, field).run()
+            added.append('%s.%s' % (table, field.db_column))
+    return added
+
+
+def apply_migration(operations):
+    """Runs the operations that can be applied, logs the others.
+    Returns the ones left to do by hand.
+    """
+    manual = []
+    for op in operations:
+        if op.run is None:
+            logger.warning('schema change to apply by hand: %s', op.description)
+            manual.append(op)
+        else:
+            logger.info('applying %s', op.description)
+            op.run()
+    return manual
+
+
+def check_migration(operations):
+    """Logs the pending operations without touching the database"""
+    for op in operations:
+        logger.warning('pending schema change: %s', op.description)
+    return operations
+
+
+def schema_fingerprint(models, database, index_specs=(), extra=()):
+    """Hash of the DDL of models and index_specs, extra strings (e.g.
+    settings affecting what the DDL step does) are hashed along
+    """
+    statements = []
+    for model in models:
+        statements.extend(model.sqlall())
+    statements.extend(index_sql(database, spec) for spec in index_specs)
+    statements.extend(str(e) for e in extra)
+    data = '\n'.join(sorted(statements)).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def _fingerprint_model(database):
+    Meta = type('Meta', (), {'database': database,
+                             'db_table': FINGERPRINT_TABLE})
+    return type('SchemaFingerprint', (peewee.Model,), {
+        'Meta': Meta,
+        'name': peewee.CharField(primary_key=True),
+        'fingerprint': peewee.CharField(),
+        'updated': peewee.DateTimeField(default=datetime.utcnow),
+    })
+
+
+def _stored_fingerprint(model, name):
+    try:
+        return model.select(model.fingerprint) \
+            .where(model.name == name).scalar()
+    except (peewee.OperationalError, peewee.ProgrammingError):
+        # no table yet, postgres needs the failed statement rolled back
+        model._meta.database.rollback()
+        return None
+
+
+@contextmanager
+def _schema_lock(database):
+    if isinstance(database, peewee.PostgresqlDatabase):
+        database.execute_sql('SELECT pg_advisory_lock(%s)', (LOCK_KEY,))
+        unlock = ('SELECT pg_advisory_unlock(%s)', (LOCK_KEY,))
+    elif isinstance(database, peewee.MySQLDatabase):
+        database.execute_sql('SELECT GET_LOCK(%s, -1)', (FINGERPRINT_TABLE,))
+        unlock = ('SELECT RELEASE_LOCK(%s)', (FINGERPRINT_TABLE,))
+    else:
+        # sqlite serializes writers and the DDL is idempotent
+        unlock = None
+    try:
+        yield
+    finally:
+        if unlock:
+            database.execute_sql(*unlock)
+
+
+def synchronize_schema(database, fingerprint, ddl, name='default'):
+    """Calls ddl unless database already has fingerprint, which costs one
+    query. Workers booting with a new fingerprint wait on a lock and check
+    again, so only the first one runs ddl. Returns True if ddl ran.
+    """
+    model = _fingerprint_model(database)
+    if _stored_fingerprint(model, name) == fingerprint:
+        return False
+    with _schema_lock(database):
+        if _stored_fingerprint(model, name) == fingerprint:
+            return False
+        ddl()
+        model.create_table(fail_silently=True)
+        with database.atomic():
+            model.delete().where(model.name == name).execute()
+            model.insert(name=name, fingerprint=fingerprint).execute()
+    return True
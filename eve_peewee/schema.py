@@ -0,0 +1,177 @@
+"""Indexes derived from the DOMAIN settings.
+
+Every allowed filter gets an index leading with the filtered column followed
+by the resource's default sort and the id, the default sort gets one of its
+own. On postgres the indexes of soft_delete resources are partial, covering
+only the rows finds can return. Resources answering conditional GETs get
+an index on _updated for their max(_updated). Filterable JSON fields get a
+GIN index on postgres, serving containment and key filters.
+"""
+from collections import namedtuple
+import hashlib
+import logging
+
+import peewee
+
+logger = logging.getLogger(__name__)
+
+
+#: columns are (column name, descending) pairs, where is raw sql or None,
+#: using the index method (None for the default btree)
+IndexSpec = namedtuple('IndexSpec', 'name table columns where unique using')
+
+# postgres truncates longer identifiers
+MAX_NAME_LENGTH = 63
+
+
+def _index_name(table, columns):
+    # descending columns are marked, (prog DESC, id) and (prog, id) differ
+    name = 'ix_%s_%s' % (table, '_'.join(c + ('_desc' if desc else '')
+                                          for c, desc in columns))
+    if len(name) > MAX_NAME_LENGTH:
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()[:8]
+        name = '%s_%s' % (name[:MAX_NAME_LENGTH - 9], digest)
+    return name
+
+
+def _column(model, name):
+    field = model._meta.fields.get(name)
+    if field is None or isinstance(field, peewee.PrimaryKeyField):
+        return None
+    return field.db_column
+
+
+def _is_jsonb(model, name):
+    return getattr(model._meta.fields.get(name), 'db_field', None) == 'jsonb'
+
+
+def plan_indexes(models, domain, database, id_field='id',
+                 conditional_get=False):
+    """IndexSpecs for the allowed_filters and default_sort of each resource
+    in domain, '*' filters are skipped as they'd mean indexing every column.
+    conditional_get is the default of the resources' 'conditional_get'
+    option.
+    """
+    specs = []
+    for resource, settings in domain.items():
+        model = models.get(resource)
+        if model is None:
+            continue
+        meta = model._meta
+        id_column = meta.fields[id_field].db_column
+
+        sort = []
+        default_sort = (settings.get('datasource') or {}).get('default_sort') or []
+        for name, direction in default_sort:
+            column = _column(model, name)
+            if column is None:
+                break
+            sort.append((column, direction < 0))
+        if sort:
+            sort.append((id_column, False))
+
+        where = None
+        if settings.get('soft_delete') and \
+                isinstance(database, peewee.PostgresqlDatabase):
+            where = '%s = false' % database.compiler().quote('_deleted')
+
+        candidates = []
+        if sort:
+            candidates.append(sort)
+        for name in settings.get('allowed_filters') or []:
+            if name == '*':
+                continue
+            column = _column(model, name)
+            if column is None:
+                continue
+            if _is_jsonb(model, name):
+                columns = [(column, False)]
+                specs.append(IndexSpec(_index_name(meta.db_table, columns) + '_gin',
+                                       meta.db_table, columns, where, False,
+                                       'gin'))
+                continue
+            candidates.append([(column, False)] +
+                              [c for c in sort if c[0] != column])
+
+        seen = set()
+        for columns in candidates:
+            key = tuple(columns)
+            if key in seen:
+                continue
+            seen.add(key)
+            specs.append(IndexSpec(_index_name(meta.db_table, columns),
+                                   meta.db_table, columns, where, False, None))
+
+        options = settings.get('_peewee') or {}
+        if options.get('conditional_get', conditional_get):
+            # whole table, soft deleted rows count as modifications
+            columns = [('_updated', False)]
+            specs.append(IndexSpec(_index_name(meta.db_table, columns),
+                                   meta.db_table, columns, None, False, None))
+    return specs
+
+
+def model_indexes(model):
+    """IndexSpecs of the indexes peewee creates with the model's table"""
+    meta = model._meta
+    compiler = meta.database.compiler()
+    specs = []
+    for fields, unique in model._index_data():
+        columns = [meta.fields[f].db_column if isinstance(f, str) else f.db_column
+                   for f in fields]
+        specs.append(IndexSpec(compiler.index_name(meta.db_table, columns),
+                               meta.db_table, [(c, False) for c in columns],
+                               None, unique, None))
+    return specs
+
+
+def index_sql(database, spec, concurrently=False):
+    quote = database.compiler().quote
+    columns = ', '.join(quote(c) + (' DESC' if desc else '')
+                        for c, desc in spec.columns)
+    sql = 'CREATE %sINDEX %s%s ON %s %s(%s)' % (
+        'UNIQUE ' if spec.unique else '',
+        'CONCURRENTLY ' if concurrently else '',
+        quote(spec.name), quote(spec.table),
+        'USING %s ' % spec.using.upper() if spec.using else '', columns)
+    if spec.where:
+        sql += ' WHERE ' + spec.where
+    return sql
+
+
+def missing_indexes(database, specs):
+    """specs not covered by an existing index, i.e. one with the same name
+    or starting with the same columns (and unique if the spec is)
+    """
+    existing = {}
+    missing = []
+    for spec in specs:
+        if spec.table not in existing:
+            existing[spec.table] = database.get_indexes(spec.table)
+        names = [c for c, _ in spec.columns]
+        covered = any(ix.name == spec.name or
+                      (ix.columns[:len(names)] == names and not spec.where and
+                       (ix.unique or not spec.unique) and
+                       (not spec.using or
+                        ('using ' + spec.using) in (ix.sql or '').lower()))
+                      for ix in existing[spec.table])
+        if not covered:
+            missing.append(spec)
+    return missing
+
+
+def provision_indexes(models, domain, database, id_field='id', dry_run=False,
+                      conditional_get=False):
+    """Creates the missing planned indexes, or only logs their DDL when
+    dry_run. Returns the statements.
+    """
+    statements = [index_sql(database, spec) for spec in missing_indexes(
+        database, plan_indexes(models, domain, database, id_field,
+                               conditional_get))]
+    for sql in statements:
+        if dry_run:
+            logger.warning('dry run: %s', sql)
+        else:
+            logger.info(sql)
+            database.execute_sql(sql)
+    return statements
@@ -1,13 +1,16 @@
 # -*- coding: utf-8 -*-
 import eve
+import flask
 import string
 import random
 import os
 import copy
 import json
+from base64 import b64encode
 
 from datetime import datetime
 from eve import ETAG
+from eve.auth import BasicAuth
 from eve.tests import TestMinimal
 from eve.utils import date_to_str
 
@@ -20,7 +23,39 @@ import peewee
 
 
 
+class QueryCounter(object):
+    """Counts statements sent through database.execute_sql"""
+    def __init__(self, database):
+        self.database = database
+        self.count = 0
+        self.queries = []
+
+    def __enter__(self):
+        execute_sql = self.database.execute_sql
+
+        def counting(sql, params=None, *args, **kwargs):
+            self.count += 1
+            self.queries.append(sql)
+            return execute_sql(sql, params, *args, **kwargs)
+        self.database.execute_sql = counting
+        return self
+
+    def __exit__(self, *exc_info):
+        del self.database.execute_sql
+
+
+class UsernameAuth(BasicAuth):
+    """Any password goes, the username is the request auth value"""
+    def check_auth(self, username, password, allowed_roles, resource,
+                   method):
+        self.set_request_auth_value(username)
+        return True
+
+
 class TestBaseSQL(TestMinimal):
+    data_layer = EvePeewee
+    # settings changed from test_settings_sql.py, e.g. DATABASE_URI
+    settings_overrides = {}
 
     def setUp(self, settings_file=None, url_converters=None):
         self.connection = None
@@ -28,9 +63,14 @@ class TestBaseSQL(TestMinimal):
         self.this_directory = os.path.dirname(os.path.realpath(__file__))
         self.settings_file = os.path.join(self.this_directory,
                                           'test_settings_sql.py')
-        self.app = eve.Eve("", settings=self.settings_file,
+        settings = self.settings_file
+        if self.settings_overrides:
+            settings = flask.Config(self.this_directory)
+            settings.from_pyfile(self.settings_file)
+            settings.update(self.settings_overrides)
+        self.app = eve.Eve("", settings=settings,
                            url_converters=url_converters,
-                           data=EvePeewee)
+                           data=self.data_layer)
 #                           validator=ValidatorSQL)
         self.test_client = self.app.test_client()
         self.app.config = copy.deepcopy(self.app.config)
@@ -113,7 +153,11 @@ class TestBaseSQL(TestMinimal):
     def dropDB(self):
         self.connection = self.app.data.driver
 #        self.connection.session.remove()
-#        self.connection.drop_all()
+        # tests write to the db, start each one from the fixture data
+        tables = list(self.app.data.models.values())
+        tables += list(self.app.data.link_tables.values())
+        self.connection.drop_tables(tables, safe=True)
+        self.connection.execute_sql('DROP TABLE IF EXISTS eve_peewee_schema')
 
     def bulk_insert(self):
         import hashlib
@@ -150,6 +194,24 @@ class TestBaseSQL(TestMinimal):
                 self.connection.session.add(payment)
             self.connection.session.commit()
 
+    def restrict_to_owner(self, resource, auth_field):
+        """Protects resource with UsernameAuth, users only see the
+        documents whose auth_field is their username
+        """
+        self.domain[resource]['authentication'] = UsernameAuth
+        self.domain[resource]['auth_field'] = auth_field
+
+    def auth_headers(self, username):
+        credentials = ('%s:secret' % username).encode('utf-8')
+        return [('Authorization',
+                 'Basic ' + b64encode(credentials).decode('ascii'))]
+
+    def insert_tags(self, count):
+        dt = datetime.now()
+        return [self.app.data.models['tags'].create(
+                    name=self.random_string(), _created=dt, _updated=dt)
+                for _ in range(count)]
+
     def random_string(self, length=6):
         return ''.join(random.choice(string.ascii_lowercase)
                        for _ in range(length)).capitalize()
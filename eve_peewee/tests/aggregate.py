@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from werkzeug.exceptions import HTTPException
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestAggregateSQL(TestBaseSQL):
+
+    def aggregate(self, pipeline):
+        with self.app.test_request_context():
+            return list(self.app.data.aggregate(self.known_resource, pipeline))
+
+    def test_group_all(self):
+        with QueryCounter(self.app.data.driver) as queries:
+            docs = self.aggregate([
+                {'$match': {'prog': {'$lt': 10}}},
+                {'$group': {'_id': None,
+                            'total': {'$sum': '$prog'},
+                            'n': {'$sum': 1},
+                            'top': {'$max': '$prog'}}}])
+        self.assertEqual(queries.count, 1)
+        self.assertEqual(docs, [{'_id': None, 'total': 45, 'n': 10, 'top': 9}])
+
+    def test_empty_match(self):
+        docs = self.aggregate([{'$match': {}},
+                               {'$group': {'_id': None, 'n': {'$sum': 1}}},
+                               {'$match': {}}])
+        self.assertEqual(docs, [{'_id': None, 'n': self.known_resource_count}])
+
+    def test_group_having_sort_limit(self):
+        model = self.app.data.models[self.known_resource]
+        model.update(lastname='A').where(model.prog < 30).execute()
+        model.update(lastname='B').where(model.prog.between(30, 59)).execute()
+        model.update(lastname='C').where(model.prog >= 60).execute()
+        docs = self.aggregate([
+            {'$group': {'_id': '$lastname', 'n': {'$count': {}},
+                        'low': {'$min': '$prog'}}},
+            {'$match': {'n': {'$gte': 30}}},
+            {'$sort': [('n', -1), ('_id', 1)]},
+            {'$limit': 2}])
+        self.assertEqual(docs, [{'_id': 'C', 'n': 41, 'low': 60},
+                                {'_id': 'A', 'n': 30, 'low': 0}])
+
+    def test_compound_id(self):
+        docs = self.aggregate([
+            {'$match': {'prog': 3}},
+            {'$group': {'_id': {'first': '$firstname', 'prog': '$prog'},
+                        'n': {'$sum': 1}}}])
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['_id']['prog'], 3)
+        self.assertEqual(docs[0]['n'], 1)
+
+    def test_unsupported(self):
+        for pipeline in ([{'$unwind': '$tags'}],
+                         [{'$limit': 1}, {'$match': {'prog': 1}}],
+                         [{'$group': {'_id': '$nope'}}]):
+            with self.assertRaises(HTTPException) as ctx:
+                self.aggregate(pipeline)
+            self.assertEqual(ctx.exception.code, 400)
+
+    def test_malformed_stages(self):
+        for pipeline in ([{'$skip': 'x'}], [{'$limit': -1}],
+                         [{'$limit': None}], [{'$limit': 1.5}],
+                         [{'$sort': {'prog': 'up'}}],
+                         [{'$sort': {'prog': 0}}],
+                         [{'$sort': {'prog': [1]}}],
+                         [{'$sort': 'prog'}], [{'$sort': [['prog']]}],
+                         [{'$sort': [[1, 1]]}]):
+            with self.assertRaises(HTTPException) as ctx:
+                self.aggregate(pipeline)
+            self.assertEqual(ctx.exception.code, 400)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestBatchSQL(TestBaseSQL):
+
+    def batch(self, operations):
+        r = self.test_client.post('/batch', data=json.dumps(operations),
+                                  content_type='application/json')
+        return self.parse_response(r)
+
+    def count(self, resource):
+        return self.app.data.models[resource].select().count()
+
+    def test_batch_mixed_writes(self):
+        # tags, eve checks people's unique firstname the mongo way
+        new = [{'method': 'POST', 'resource': 'tags',
+                'payload': {'name': self.random_string(12)}}
+               for i in range(3)]
+        operations = new + [
+            {'method': 'PATCH', 'resource': 'people', 'id': self.item_id,
+             'payload': {'lastname': 'Batched'}, 'etag': self.item_etag},
+            {'method': 'DELETE', 'resource': 'people', 'id': self.item_id},
+        ]
+        with QueryCounter(self.app.data.driver) as queries:
+            response, status = self.batch(operations)
+        self.assert200(status)
+        items = response['_items']
+        self.assertEqual(len(items), len(operations))
+        self.assertTrue(all(item['_status'] == 'OK' for item in items[:4]))
+        # the three POSTs are inserted together
+        inserts = [q for q in queries.queries if q.startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+        self.assertEqual(self.count('tags'), 3)
+        self.assertEqual(self.count('people'), self.known_resource_count - 1)
+        r = self.test_client.get(self.item_id_url)
+        self.assert404(r.status_code)
+
+    def test_batch_rolled_back(self):
+        operations = [
+            {'method': 'POST', 'resource': 'tags',
+             'payload': {'name': self.random_string(12)}},
+            {'method': 'PATCH', 'resource': 'people', 'id': self.item_id,
+             'payload': {'lastname': 'Stale'}, 'etag': 'not-the-etag'},
+        ]
+        response, status = self.batch(operations)
+        self.assertEqual(status, 412)
+        self.assertEqual(response['_status'], 'ERR')
+        self.assertEqual(response['_items'][1]['_error']['code'], 412)
+        self.assertEqual(self.count('tags'), 0)
+
+    def test_batch_method_not_allowed(self):
+        response, status = self.batch([{'method': 'PATCH', 'resource': 'payments',
+                                        'id': 1, 'payload': {}}])
+        self.assertEqual(status, 405)
+
+    def test_batch_bad_body(self):
+        response, status = self.batch({'method': 'POST'})
+        self.assert400(status)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from eve.utils import ParsedRequest
+
+from eve_peewee import EvePeewee
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+try:
+    import asyncio
+    import aiosqlite
+    from eve_peewee.aio import AsyncEvePeewee
+except (ImportError, SyntaxError):
+    AsyncEvePeewee = None
+
+
+def report(name, value):
+    print('\n%-40s %s' % (name, value))
+
+
+class TestItemQueries(TestBaseSQL):
+
+    def test_getitem_single_query(self):
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.get(self.item_id_url)
+        self.assert200(r.status_code)
+        report('queries per item GET', queries.count)
+        self.assertEqual(queries.count, 1)
+
+    def test_getitem_prepared_once(self):
+        self.test_client.get(self.item_id_url)
+        prepared = dict(self.app.data._prepared)
+        rounds = 200
+        start = time.time()
+        for _ in range(rounds):
+            r = self.test_client.get(self.item_id_url)
+        elapsed = time.time() - start
+        self.assert200(r.status_code)
+        self.assertEqual(self.app.data._prepared, prepared)
+        report('item GET ms', '%.3f' % (elapsed * 1000 / rounds))
+
+    def test_getitem_missing(self):
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.get(self.unknown_item_id_url)
+        self.assert404(r.status_code)
+        self.assertEqual(queries.count, 1)
+
+
+class TestFilterValidation(TestBaseSQL):
+
+    def filtered_gets(self, rounds, uncached=False):
+        where = '?where={"firstname": "%s"}' % self.item_firstname
+        start = time.time()
+        for _ in range(rounds):
+            if uncached:
+                self.app.data.invalidate_filter_validators()
+            r = self.test_client.get(self.known_resource_url + where)
+        self.assert200(r.status_code)
+        return (time.time() - start) * 1000 / rounds
+
+    def test_filtered_get_validators(self):
+        self.domain[self.known_resource]['allowed_filters'] = ['firstname']
+        rounds = 200
+        self.filtered_gets(10)
+        uncached = self.filtered_gets(rounds, uncached=True)
+        cached = self.filtered_gets(rounds)
+        report('filtered GET ms, validators rebuilt', '%.3f' % uncached)
+        report('filtered GET ms, validators cached', '%.3f' % cached)
+        checks = self.app.data._filter_checks
+        self.assertEqual(list(checks), [(self.known_resource, ('firstname',))])
+
+    def test_filtered_get_rejects_every_key(self):
+        self.domain[self.known_resource]['allowed_filters'] = ['firstname',
+                                                                'prog']
+        where = '?where={"firstname": "%s", "prog": "x"}' % self.item_firstname
+        r = self.test_client.get(self.known_resource_url + where)
+        self.assert400(r.status_code)
+
+
+@pytest.mark.skipif(AsyncEvePeewee is None,
+                    reason='needs python 3.5+ and aiosqlite')
+class TestAsyncConcurrency(TestBaseSQL):
+    data_layer = AsyncEvePeewee or EvePeewee
+
+    def test_find_one_in_flight(self):
+        data = self.app.data
+        rounds = 200
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        with self.app.app_context():
+            start = time.time()
+            for _ in range(rounds):
+                data.find_one(self.known_resource, None, id=self.item_id)
+            sync = time.time() - start
+
+            loop.run_until_complete(data.connect())
+            try:
+                start = time.time()
+                docs = loop.run_until_complete(asyncio.gather(*[
+                    data.find_one_async(self.known_resource, None, id=self.item_id)
+                    for _ in range(rounds)]))
+                concurrent = time.time() - start
+                count = loop.run_until_complete(
+                    data.count_async(self.known_resource, ParsedRequest()))
+            finally:
+                loop.run_until_complete(data.close())
+                loop.close()
+        self.assertEqual(set(doc['firstname'] for doc in docs),
+                         set([self.item_firstname]))
+        self.assertEqual(count, self.known_resource_count)
+        report('find_one ms, sync sequential', '%.3f' % (sync * 1000 / rounds))
+        report('find_one ms, %d async in flight' % rounds,
+               '%.3f' % (concurrent * 1000 / rounds))
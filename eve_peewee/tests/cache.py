@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import json
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestResultCacheSQL(TestBaseSQL):
+
+    def setUp(self):
+        super(TestResultCacheSQL, self).setUp()
+        self.domain[self.known_resource]['_peewee']['result_cache'] = True
+
+    def queries(self, url):
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.get(url)
+        self.assert200(r.status_code)
+        return queries.count
+
+    def test_find_cached_between_writes(self):
+        url = self.known_resource_url + '?max_results=5'
+        self.assertTrue(self.queries(url))
+        self.assertEqual(self.queries(url), 0)
+        # another page is another entry
+        self.assertTrue(self.queries(url + '&page=2'))
+
+        r = self.test_client.patch(self.item_id_url,
+                                   data=json.dumps({'lastname': 'Cached'}),
+                                   headers=[('If-Match', self.item_etag)],
+                                   content_type='application/json')
+        self.assert200(r.status_code)
+        self.assertTrue(self.queries(url))
+        response, status = self.get(self.known_resource, item=self.item_id)
+        self.assertEqual(response['lastname'], 'Cached')
+
+    def test_find_one_cached(self):
+        self.assertTrue(self.queries(self.item_id_url))
+        self.assertEqual(self.queries(self.item_id_url), 0)
+        response, status = self.get(self.known_resource, item=self.item_id)
+        self.assertEqual(response['firstname'], self.item_firstname)
+
+    def test_embedded_not_cached(self):
+        self.domain['notes']['_peewee'] = {'result_cache': True}
+        notes = self.app.data.models['notes']
+        people = self.app.data.models[self.known_resource]
+        for person in people.select().limit(5):
+            notes.create(text='note', person=person, _created=person._created,
+                         _updated=person._created)
+        url = '/notes?max_results=5&embedded={"person": 1}'
+        counts = [self.queries(url) for _ in range(2)]
+        self.assertTrue(counts[0])
+        self.assertEqual(counts[0], counts[1])
+        response, status = self.get('notes', '?embedded={"person": 1}')
+        person = response['_items'][0]['person']
+        self.assertEqual(person['firstname'],
+                         people.get(people.id == person['id']).firstname)
+        # without embedding the page is cached
+        self.queries('/notes?max_results=5')
+        self.assertEqual(self.queries('/notes?max_results=5'), 0)
+
+    def test_dependents_invalidated(self):
+        data = self.app.data
+        self.assertIn('notes', data._dependents[self.known_resource])
+        with self.app.test_request_context():
+            notes = data._generation('notes')
+            tags = data._generation('tags')
+            data._invalidate(self.known_resource)
+            self.assertNotEqual(data._generation('notes'), notes)
+            self.assertEqual(data._generation('tags'), tags)
+
+    def test_auth_value_in_key(self):
+        self.restrict_to_owner(self.known_resource, 'lastname')
+        people = self.app.data.models[self.known_resource]
+        people.update(lastname='alice').where(people.prog < 3).execute()
+        people.update(lastname='bob').where(
+            (people.prog >= 3) & (people.prog < 5)).execute()
+
+        url = self.known_resource_url + '?max_results=5'
+        for user, progs in (('alice', [0, 1, 2]), ('bob', [3, 4]),
+                            ('alice', [0, 1, 2])):
+            r = self.test_client.get(url, headers=self.auth_headers(user))
+            response, status = self.parse_response(r)
+            self.assert200(status)
+            self.assertEqual(sorted(i['prog'] for i in response['_items']),
+                             progs)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestDeleteSQL(TestBaseSQL):
+
+    def test_soft_delete_collection_single_statement(self):
+        self.domain[self.known_resource]['soft_delete'] = True
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.delete(self.known_resource_url)
+        self.assert204(r.status_code)
+        updates = [q for q in queries.queries if q.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse([q for q in queries.queries if q.startswith('DELETE')])
+
+        model = self.app.data.models[self.known_resource]
+        self.assertEqual(model.select().count(), self.known_resource_count)
+        self.assertEqual(model.select().where(model._deleted == False).count(), 0)
+
+        response, status = self.get(self.known_resource)
+        self.assert200(status)
+        self.assertEqual(len(response['_items']), 0)
+        r = self.test_client.get(self.item_id_url)
+        self.assert404(r.status_code)
+
+    def test_soft_delete_remove_lookup(self):
+        self.domain[self.known_resource]['soft_delete'] = True
+        with self.app.test_request_context():
+            count = self.app.data.remove(self.known_resource, {'prog__lt': 10})
+        self.assertEqual(count, 10)
+        model = self.app.data.models[self.known_resource]
+        self.assertEqual(model.select().where(model._deleted == True).count(), 10)
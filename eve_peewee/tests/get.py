@@ -1,11 +1,13 @@
 import pytest
 import json
+import sqlite3
 
 from datetime import datetime
 from eve.tests.utils import DummyEvent
-from eve.utils import date_to_str, str_to_date
+from eve.utils import date_to_str, str_to_date, ParsedRequest, \
+    date_to_rfc1123
 
-from eve_peewee.tests import TestBaseSQL
+from eve_peewee.tests import TestBaseSQL, QueryCounter
 
 
 class TestGetSQL(TestBaseSQL):
@@ -54,6 +56,200 @@ class TestGetSQL(TestBaseSQL):
         self.assertLastLink(links, None)
         self.assertPagination(response, 5, 101, 25)
 
+    def test_get_keyset_page(self):
+        self.domain[self.known_resource]['_peewee'] = {'pagination': 'keyset'}
+        response, status = self.get(self.known_resource, '?sort=prog')
+        self.assert200(status)
+        self.assertEqual([item['prog'] for item in response['_items']],
+                         list(range(25)))
+        links = response['_links']
+        self.assertTrue('prev' not in links)
+        self.assertTrue('last' not in links)
+        self.assertTrue('cursor=' in links['next']['href'])
+
+        r = self.test_client.get('/' + links['next']['href'])
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        self.assertEqual([item['prog'] for item in response['_items']],
+                         list(range(25, 50)))
+        self.assertEqual(response['_meta']['total'], 101)
+
+        r = self.test_client.get('/' + response['_links']['prev']['href'])
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        self.assertEqual([item['prog'] for item in response['_items']],
+                         list(range(25)))
+
+    def test_get_keyset_page_desc(self):
+        self.domain[self.known_resource]['_peewee'] = {'pagination': 'keyset'}
+        response, _ = self.get(self.known_resource, '?sort=-prog&max_results=50')
+        r = self.test_client.get('/' + response['_links']['next']['href'])
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        self.assertEqual([item['prog'] for item in response['_items']],
+                         list(range(50, 0, -1)))
+        r = self.test_client.get('/' + response['_links']['next']['href'])
+        response, status = self.parse_response(r)
+        self.assertEqual([item['prog'] for item in response['_items']], [0])
+        self.assertTrue('next' not in response['_links'])
+
+    def test_get_keyset_bad_cursor(self):
+        self.domain[self.known_resource]['_peewee'] = {'pagination': 'keyset'}
+        r = self.test_client.get(self.known_resource_url + '?cursor=garbage')
+        self.assert400(r.status_code)
+
+    def test_get_count_has_more(self):
+        self.domain[self.known_resource]['_peewee'] = {'count': 'has_more'}
+        r = self.test_client.get(self.known_resource_url)
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        self.assertEqual(len(response['_items']), 25)
+        self.assertEqual(r.headers['X-Count-Strategy'], 'has_more')
+        self.assertEqual(response['_meta']['total'], 26)
+        self.assertTrue('last' not in response['_links'])
+
+        response, status = self.get(self.known_resource, '?page=5')
+        self.assertEqual(len(response['_items']), 1)
+        self.assertEqual(response['_meta']['total'], 101)
+
+    def test_get_count_strategy_xml(self):
+        self.domain[self.known_resource]['_peewee'] = {'count': 'has_more'}
+        r = self.test_client.get(self.known_resource_url,
+                                 headers=[('Accept', 'application/xml')])
+        self.assert200(r.status_code)
+        self.assertEqual(r.headers['X-Count-Strategy'], 'has_more')
+        self.assertIn(b'<total>26</total>', r.get_data())
+
+    def test_get_count_cached(self):
+        self.domain[self.known_resource]['_peewee'] = {'count': 'cached'}
+        r = self.test_client.get(self.known_resource_url)
+        response, status = self.parse_response(r)
+        self.assertEqual(r.headers['X-Count-Strategy'], 'cached')
+        self.assertEqual(response['_meta']['total'], 101)
+        self.app.data.models[self.known_resource].delete().where(
+            self.app.data.models[self.known_resource].prog == 0).execute()
+        response, status = self.get(self.known_resource)
+        self.assertEqual(response['_meta']['total'], 101)
+
+    @pytest.mark.skipif(sqlite3.sqlite_version_info < (3, 25),
+                        reason='no window functions')
+    def test_get_count_window(self):
+        self.domain[self.known_resource]['_peewee'] = {'count': 'window'}
+        r = self.test_client.get(self.known_resource_url + '?page=2')
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        self.assertEqual(r.headers['X-Count-Strategy'], 'window')
+        self.assertEqual(response['_meta']['total'], 101)
+        for item in response['_items']:
+            self.assertTrue('_eve_peewee_total' not in item)
+
+    def test_get_query_plan_reused(self):
+        plans = self.app.data.query_plans
+        plans.clear()
+        hits = plans.hits
+        for name in ('Alice', 'Bob'):
+            where = '?where={"firstname": "%s"}&sort=-prog' % name
+            r = self.test_client.get(self.known_resource_url + where)
+            self.assert200(r.status_code)
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(plans.hits, hits + 1)
+
+        r = self.test_client.get(self.known_resource_url + '?sort=-prog')
+        self.assert200(r.status_code)
+        self.assertEqual(len(plans), 2)
+
+    def test_find_streams_rows(self):
+        with self.app.test_request_context():
+            req = ParsedRequest()
+            req.max_results = 0
+            rs = self.app.data.find(self.known_resource, req, {})
+            docs = list(rs)
+        self.assertEqual(len(docs), self.known_resource_count)
+        self.assertTrue(all(isinstance(doc, dict) for doc in docs))
+        # nothing is cached on the result wrapper
+        self.assertEqual(len(rs._result_cache), 0)
+
+    def test_export_ndjson(self):
+        r = self.test_client.get(self.known_resource_url + '/export')
+        self.assert200(r.status_code)
+        self.assertEqual(r.mimetype, 'application/x-ndjson')
+        lines = r.get_data().decode('utf-8').splitlines()
+        self.assertEqual(len(lines), self.known_resource_count)
+        self.assertTrue('firstname' in json.loads(lines[0]))
+
+    def test_export_json_where_sort(self):
+        query = '?format=json&where={"prog": 3}'
+        r = self.test_client.get(self.known_resource_url + '/export' + query)
+        self.assert200(r.status_code)
+        docs = json.loads(r.get_data().decode('utf-8'))
+        self.assertEqual([doc['prog'] for doc in docs], [3])
+
+        self.app.config['PEEWEE_ITERSIZE'] = 7
+        query = '?format=json&sort=-prog'
+        r = self.test_client.get(self.known_resource_url + '/export' + query)
+        docs = json.loads(r.get_data().decode('utf-8'))
+        self.assertEqual([doc['prog'] for doc in docs],
+                         list(range(self.known_resource_count - 1, -1, -1)))
+
+    def test_export_unknown_format(self):
+        r = self.test_client.get(self.known_resource_url + '/export?format=xml')
+        self.assert400(r.status_code)
+
+    def insert_notes(self, count, tags_per_note=3):
+        models = self.app.data.models
+        link = self.app.data.link_tables['notes_tags']
+        dt = datetime.now()
+        stamps = {'_created': dt, '_updated': dt}
+        people = list(models['people'].select().limit(count))
+        tags = self.insert_tags(tags_per_note)
+        notes = []
+        for person in people:
+            note = models['notes'].create(text=self.random_string(),
+                                          person=person, **stamps)
+            for tag in tags:
+                link.create(notes=note, tags=tag, **stamps)
+            notes.append(note)
+        return notes, tags
+
+    def test_get_embedded_constant_queries(self):
+        notes, tags = self.insert_notes(20)
+        embedded = '?embedded={"person": 1, "tags": 1}'
+        db = self.app.data.driver
+
+        with QueryCounter(db) as few:
+            response, status = self.get('notes', embedded + '&max_results=2')
+        self.assert200(status)
+        with QueryCounter(db) as many:
+            response, status = self.get('notes', embedded + '&max_results=20')
+        self.assert200(status)
+        self.assertEqual(few.count, many.count)
+
+        items = response['_items']
+        self.assertEqual(len(items), 20)
+        for item, note in zip(sorted(items, key=lambda i: i['id']), notes):
+            self.assertEqual(item['person']['id'], note.person_id)
+            self.assertEqual(item['person']['firstname'], note.person.firstname)
+            self.assertEqual([t['name'] for t in item['tags']],
+                             [t.name for t in tags])
+
+    def test_get_relation_ids(self):
+        notes, tags = self.insert_notes(2)
+        response, status = self.get('notes')
+        self.assert200(status)
+        item = response['_items'][0]
+        self.assertEqual(item['person'], notes[0].person_id)
+        self.assertEqual(item['tags'], [t.id for t in tags])
+
+        response, status = self.get('notes', '?embedded={"tags": 1}',
+                                    item=notes[0].id)
+        self.assert200(status)
+        self.assertEqual(response['person'], notes[0].person_id)
+        self.assertEqual([t['id'] for t in response['tags']],
+                         [t.id for t in tags])
+
+        response, status = self.get('notes', '?projection={"text": 1}')
+        self.assertTrue('tags' not in response['_items'][0])
+
     def test_get_max_results(self):
         maxr = 10
         response, status = self.get(self.known_resource,
@@ -174,8 +370,7 @@ class TestGetSQL(TestBaseSQL):
         s['default_sort'] = [('prog', -1)]
         self.app.set_defaults()
         response, _ = self.get(self.known_resource)
-        # TODO: fix sort
-        #self.assertEqual(self.response_item(response, 0)['prog'], 100)
+        self.assertEqual(self.response_item(response, 0)['prog'], 100)
 
         # set default sort to 'prog', asc.
         s['default_sort'] = [('prog', 1)]
@@ -193,6 +388,30 @@ class TestGetSQL(TestBaseSQL):
     def test_expires(self):
         self.assertExpires(self.known_resource_url)
 
+    def test_get_ims_collection(self):
+        self.domain[self.known_resource]['_peewee']['conditional_get'] = True
+        model = self.app.data.models[self.known_resource]
+        updated = datetime(2016, 1, 1)
+        model.update(_updated=updated).execute()
+        with self.app.test_request_context():
+            self.assertEqual(
+                self.app.data.last_modified(self.known_resource), updated)
+        headers = [('If-Modified-Since', date_to_rfc1123(updated))]
+        # max(_updated) was read above
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.get(self.known_resource_url, headers=headers)
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(queries.count, 0)
+
+        item, _ = self.get(self.known_resource, item=self.item_id)
+        r = self.test_client.patch(self.item_id_url,
+                                   data=json.dumps({'lastname': 'Newer'}),
+                                   headers=[('If-Match', item['_etag'])],
+                                   content_type='application/json')
+        self.assert200(r.status_code)
+        r = self.test_client.get(self.known_resource_url, headers=headers)
+        self.assert200(r.status_code)
+
     def test_get(self):
         response, status = self.get(self.known_resource)
         self.assert_get(response, status)
@@ -232,6 +451,18 @@ class TestGetSQL(TestBaseSQL):
                                            '?where=%s' % where))
         self.assert200(r.status_code)
  
+    def test_get_where_allowed_filters_eve_rules(self):
+        # unique and data_relation aren't cerberus rules
+        self.app.config['DOMAIN']['notes']['allowed_filters'] = \
+            ['person', 'tags']
+        r = self.test_client.get('/notes?where={"person": 1}')
+        self.assert200(r.status_code)
+        self.app.config['DOMAIN'][self.known_resource]['allowed_filters'] = \
+            ['firstname']
+        r = self.test_client.get('%s?where={"firstname": 1}' %
+                                 self.known_resource_url)
+        self.assert400(r.status_code)
+
     def test_get_where_like(self):
         r = self.test_client.get("{0}{1}".format(
             self.known_resource_url,
@@ -402,6 +633,16 @@ class TestGetSQL(TestBaseSQL):
         _db.session.rollback()
         """
 
+    def test_getitem_auth_field(self):
+        self.restrict_to_owner(self.known_resource, 'lastname')
+        people = self.app.data.models[self.known_resource]
+        people.update(lastname='alice').where(
+            people.id == self.item_id).execute()
+        for user, status in (('alice', 200), ('bob', 404), ('alice', 200)):
+            r = self.test_client.get(self.item_id_url,
+                                     headers=self.auth_headers(user))
+            self.assertEqual(r.status_code, status)
+
     """
     def test_get_embedded(self):
         _db = self.app.data.driver
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import json
+
+import peewee
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from eve_peewee import PeeweeJSONEncoder
+from eve_peewee.fields import JSONTextField, MsgpackField, LazyJSON
+from eve_peewee.tests import TestBaseSQL
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class TestJSONFilterSQL(TestBaseSQL):
+
+    def setUp(self):
+        super(TestJSONFilterSQL, self).setUp()
+        db = self.app.data.driver
+
+        class Listing(peewee.Model):
+            features = JSONTextField()
+
+            class Meta:
+                database = db
+
+        Listing.create_table(fail_silently=True)
+        for features in ({'rooms': 2, 'tags': ['garden']},
+                         {'rooms': 4, 'pool': True,
+                          'tags': ['garden', 'garage']},
+                         {'rooms': 5, 'address': {'city': 'Oulu'}}):
+            Listing.create(features=features)
+        self.app.data._json_fields[Listing] = set(['features'])
+        self.listing = Listing
+
+    def tearDown(self):
+        self.listing.drop_table()
+        super(TestJSONFilterSQL, self).tearDown()
+
+    def rooms(self, where):
+        op = self.app.data._parse_where(self.listing.select(), where)
+        return sorted(l.features['rooms'] for l in op)
+
+    def test_path(self):
+        self.assertEqual(self.rooms({'features.rooms__gt': 3}), [4, 5])
+        self.assertEqual(self.rooms({'features.rooms__lte': 4,
+                                     'features.rooms__ne': 2}), [4])
+        self.assertEqual(self.rooms({'features.address.city': 'Oulu'}), [5])
+
+    def test_contains(self):
+        self.assertEqual(
+            self.rooms({'features__contains': {'tags': ['garage']}}), [4])
+        self.assertEqual(self.rooms({'features__contains': {'rooms': 2}}), [2])
+        self.assertEqual(self.rooms({'features.tags__contains': ['garden']}),
+                         [2, 4])
+
+    def test_has_key(self):
+        self.assertEqual(self.rooms({'features__has_key': 'pool'}), [4])
+
+    def test_invalid(self):
+        for where in ({'features.a;b': 1}, {'features.rooms__near': 1}):
+            with self.assertRaises(HTTPException) as ctx:
+                self.rooms(where)
+            self.assertEqual(ctx.exception.code, 400)
+
+    def test_storage(self):
+        self.assertIs(self.app.data._json_field_type(), JSONTextField)
+        cursor = self.app.data.driver.execute_sql(
+            'SELECT features FROM listing ORDER BY id')
+        raw = cursor.fetchone()[0]
+        # compact separators
+        self.assertNotIn(' ', raw)
+        self.assertEqual(json.loads(raw), {'rooms': 2, 'tags': ['garden']})
+
+    def test_lazy(self):
+        listing = self.listing.select() \
+            .where(self.listing.features.contains('Oulu')).get()
+        self.assertIsInstance(listing.features, LazyJSON)
+        self.assertEqual(listing.features['address'], {'city': 'Oulu'})
+        self.assertEqual(
+            json.loads(json.dumps(listing.features,
+                                  default=PeeweeJSONEncoder().default)),
+            {'rooms': 5, 'address': {'city': 'Oulu'}})
+        # saved back as read
+        listing.save()
+        self.assertEqual(self.rooms({'features.address.city': 'Oulu'}), [5])
+
+class TestJSONDocumentsSQL(TestBaseSQL):
+
+    def post_note(self, extra):
+        r = self.test_client.post('/notes', data=json.dumps({'extra': extra}),
+                                  content_type='application/json')
+        self.assert201(r.status_code)
+
+    def test_dict_field(self):
+        self.assertIsInstance(self.app.data.models['notes'].extra,
+                              JSONTextField)
+        extra = {'key': 'a', 'sizes': [1, 2]}
+        self.post_note(extra)
+        self.post_note({'key': 'b'})
+
+        url = '/notes?where=%s' % json.dumps({'extra.key': 'a'})
+        response, status = self.parse_response(self.test_client.get(url))
+        self.assert200(status)
+        self.assertEqual([n['extra'] for n in response['_items']], [extra])
+
+        r = self.test_client.get(url, headers=[('Accept', 'application/xml')])
+        self.assert200(r.status_code)
+        self.assertIn(b'<key>a</key>', r.get_data())
+        self.assertNotIn(b'LazyJSON', r.get_data())
+
+        item_url = '/notes/%s' % response['_items'][0]['id']
+        response, status = self.parse_response(self.test_client.get(item_url))
+        self.assertEqual(response['extra'], extra)
+
+
+@pytest.mark.skipif(msgpack is None, reason='needs msgpack')
+class TestMsgpackStorageSQL(TestBaseSQL):
+
+    def test_round_trip(self):
+        db = self.app.data.driver
+
+        class Packed(peewee.Model):
+            doc = MsgpackField(null=True)
+
+            class Meta:
+                database = db
+
+        Packed.create_table(fail_silently=True)
+        try:
+            value = {'name': u'\xe4', 'tags': [1, 2.5, None]}
+            Packed.create(doc=value)
+            Packed.create(doc=None)
+            docs = [p.doc for p in Packed.select().order_by(Packed.id)]
+            self.assertEqual(docs, [value, None])
+        finally:
+            Packed.drop_table()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+
+from playhouse.migrate import SchemaMigrator
+
+from eve_peewee.migrate import apply_migration, synchronize_schema
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestMigrateSQL(TestBaseSQL):
+
+    def plan(self):
+        return [op.description for op in self.app.data.migration_plan()]
+
+    def test_up_to_date(self):
+        self.assertEqual(self.plan(), [])
+
+    def test_add_column(self):
+        db = self.app.data.driver
+        SchemaMigrator.from_database(db).drop_column(
+            self.known_resource, 'lastname').run()
+        self.assertEqual(self.plan(), ['add column people.lastname'])
+
+        self.assertEqual(apply_migration(self.app.data.migration_plan()), [])
+        self.assertEqual(self.plan(), [])
+        response, status = self.get(self.known_resource)
+        self.assert200(status)
+
+    def test_etag_column_added_on_init(self):
+        db = self.app.data.driver
+        SchemaMigrator.from_database(db).drop_column('tags', '_etag').run()
+        self.app.data._create_schema(self.app.config)
+        self.assertEqual(self.plan(), [])
+
+        r = self.test_client.post('/tags', data=json.dumps({'name': 'etag'}),
+                                  content_type='application/json')
+        self.assert201(r.status_code)
+        posted, _ = self.parse_response(r)
+        stored, status = self.get('tags', item=posted['id'])
+        self.assertEqual(stored['_etag'], posted['_etag'])
+
+    def test_missing_unique_index(self):
+        db = self.app.data.driver
+        name = [ix.name for ix in db.get_indexes(self.known_resource)
+                if ix.columns == ['firstname']][0]
+        db.execute_sql('DROP INDEX %s' % db.compiler().quote(name))
+        self.assertEqual(self.plan(), [
+            'CREATE UNIQUE INDEX "%s" ON "people" ("firstname")' % name])
+
+        apply_migration(self.app.data.migration_plan())
+        self.assertEqual(self.plan(), [])
+
+    def test_manual_changes(self):
+        db = self.app.data.driver
+        db.execute_sql('ALTER TABLE people ADD COLUMN legacy TEXT')
+        plan = self.app.data.migration_plan()
+        self.assertEqual([op.description for op in plan],
+                         ['column people.legacy is not in the schema'])
+        self.assertEqual(apply_migration(plan), plan)
+
+    def test_schema_fingerprint(self):
+        db = self.app.data.driver
+        fingerprint = self.app.data.schema_fingerprint()
+        self.assertEqual(fingerprint, self.app.data.schema_fingerprint())
+        self.assertTrue(self.app.data.startup_timings['models'] >= 0)
+
+        runs = []
+        self.assertTrue(synchronize_schema(db, fingerprint,
+                                           lambda: runs.append(1)))
+        with QueryCounter(db) as counter:
+            self.assertFalse(synchronize_schema(db, fingerprint,
+                                                lambda: runs.append(1)))
+        self.assertEqual(counter.count, 1)
+        self.assertEqual(runs, [1])
+
+        # a changed DOMAIN runs the DDL again
+        self.app.config['PEEWEE_AUTO_INDEX'] = True
+        changed = self.app.data.schema_fingerprint()
+        self.assertNotEqual(changed, fingerprint)
+        self.assertTrue(synchronize_schema(db, changed, lambda: runs.append(1)))
+        self.assertEqual(runs, [1, 1])
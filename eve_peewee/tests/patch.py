@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import json
+
+from werkzeug.exceptions import HTTPException
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestPatchSQL(TestBaseSQL):
+
+    def patch_item(self, changes):
+        return self.test_client.patch(self.item_id_url,
+                                      data=json.dumps(changes),
+                                      headers=[('If-Match', self.item_etag)],
+                                      content_type='application/json')
+
+    def test_patch_single_statement(self):
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.patch_item({'lastname': 'Patched'})
+        self.assert200(r.status_code)
+        updates = [q for q in queries.queries if q.startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        # only the patched column and the timestamp are written
+        self.assertTrue('"firstname"' not in updates[0])
+        # one select for eve's etag check, none before the update
+        selects = [q for q in queries.queries if q.startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+
+        response, status = self.parse_response(
+            self.test_client.get(self.item_id_url))
+        self.assertEqual(response['lastname'], 'Patched')
+        self.assertEqual(response['firstname'], self.item_firstname)
+
+    def test_patch_stale_original(self):
+        id_field = self.app.config['ID_FIELD']
+        data = self.app.data
+        with self.app.test_request_context():
+            original = data.find_one(self.known_resource, None,
+                                     **{id_field: self.item_id})
+            data.update(self.known_resource, self.item_id,
+                        {'lastname': 'First'}, original)
+            with self.assertRaises(HTTPException) as ctx:
+                data.update(self.known_resource, self.item_id,
+                            {'lastname': 'Second'}, original)
+            self.assertEqual(ctx.exception.code, 412)
+
+            with self.assertRaises(HTTPException) as ctx:
+                data.update(self.known_resource, self.unknown_item_id,
+                            {'lastname': 'Second'}, None)
+            self.assertEqual(ctx.exception.code, 404)
+
+    def test_patch_links_diff(self):
+        a, b, c, d = [tag.id for tag in self.insert_tags(4)]
+        r = self.test_client.post('/notes',
+                                  data=json.dumps({'text': 'linked',
+                                                   'tags': [a, b, c]}),
+                                  content_type='application/json')
+        note, status = self.parse_response(r)
+        self.assert201(status)
+
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.patch('/notes/%s' % note['id'],
+                                       data=json.dumps({'tags': [b, c, d]}),
+                                       headers=[('If-Match', note['_etag'])],
+                                       content_type='application/json')
+        self.assert200(r.status_code)
+        for statement in ('INSERT', 'DELETE'):
+            self.assertEqual(len([q for q in queries.queries
+                                  if q.startswith(statement)]), 1)
+
+        stored, status = self.get('notes', item=note['id'])
+        self.assertEqual(stored['tags'], [b, c, d])
+
+        # the stored etag is the one returned by the write
+        patched, _ = self.parse_response(r)
+        self.assertEqual(stored['_etag'], patched['_etag'])
+        r = self.test_client.delete('/notes/%s' % note['id'],
+                                    headers=[('If-Match', patched['_etag'])])
+        self.assert204(r.status_code)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+from datetime import datetime
+
+from eve_peewee.tests import TestBaseSQL
+
+
+class TestPoolSQL(TestBaseSQL):
+    settings_overrides = {
+        'DATABASE_URI': 'sqlite+pool:///%s' % os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), 'test.db')}
+
+    def setUp(self):
+        super(TestPoolSQL, self).setUp()
+        self.db = self.app.data.driver
+        # the connection setUp used outside of a request
+        self.db.close()
+
+    def tearDown(self):
+        super(TestPoolSQL, self).tearDown()
+        self.db.close()
+        self.db.close_all()
+
+    def pooled(self):
+        return [conn for _, conn in self.db._connections]
+
+    def test_connection_per_request(self):
+        used = []
+
+        def fetched(resource, response):
+            self.assertFalse(self.db.is_closed())
+            used.append(self.db.get_conn())
+        self.app.on_fetched_resource += fetched
+
+        for _ in range(2):
+            response, status = self.get(self.known_resource)
+            self.assert200(status)
+            self.assertTrue(self.db.is_closed())
+            self.assertEqual(self.db._in_use, {})
+        # the second request got the connection back from the pool
+        self.assertEqual(self.pooled(), used[:1])
+        self.assertIs(used[0], used[1])
+
+    def test_rollback_on_error(self):
+        tags = self.app.data.models['tags']
+        now = datetime.utcnow()
+        with self.app.test_request_context():
+            self.app.data._connect_db()
+            self.db.execute_sql('BEGIN', require_commit=False)
+            sql, params = tags.insert(name='rolled back', _created=now,
+                                      _updated=now).sql()
+            self.db.execute_sql(sql, params, require_commit=False)
+            self.app.data._close_db(ValueError('failed request'))
+            self.assertTrue(self.db.is_closed())
+        self.assertEqual(len(self.pooled()), 1)
+        self.assertEqual(tags.select().where(
+            tags.name == 'rolled back').count(), 0)
+
+    def test_retry_evicts_failed_connection(self):
+        with self.app.test_request_context():
+            self.app.data._connect_db()
+            failed = self.db.get_conn()
+
+            def lost_connection():
+                del self.db.get_cursor
+                raise sqlite3.OperationalError('connection lost')
+            self.db.get_cursor = lost_connection
+
+            self.assertEqual(
+                self.db.execute_sql('SELECT 1').fetchone(), (1,))
+            self.assertIsNot(self.db.get_conn(), failed)
+        self.assertNotIn(failed, self.pooled())
+        self.assertRaises(sqlite3.ProgrammingError, failed.execute,
+                          'SELECT 1')
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import json
+
+import peewee
+
+from eve_peewee.tests import TestBaseSQL, QueryCounter
+
+
+class TestPostSQL(TestBaseSQL):
+
+    def post_tags(self, count):
+        # tags have no unique fields, which eve checks the mongo way
+        data = [{'name': self.random_string(12)} for i in range(count)]
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.post('/tags', data=json.dumps(data),
+                                      content_type='application/json')
+        response, status = self.parse_response(r)
+        self.assert201(status)
+        inserts = [q for q in queries.queries if q.startswith('INSERT')]
+        return data, response['_items'], inserts
+
+    def assert_inserted(self, data, items):
+        id_field = self.app.config['ID_FIELD']
+        self.assertEqual(len(items), len(data))
+        for doc, item in zip(data, items):
+            stored, status = self.get('tags', item=item[id_field])
+            self.assert200(status)
+            self.assertEqual(stored['name'], doc['name'])
+
+    def test_post_bulk_single_statement(self):
+        data, items, inserts = self.post_tags(5)
+        self.assertEqual(len(inserts), 1)
+        self.assert_inserted(data, items)
+
+    def test_post_bulk_chunked(self):
+        # every field but the auto id is a parameter, one row per statement
+        row = len(self.app.data.models['tags']._meta.fields) - 1
+        self.app.data.max_query_params = ((peewee.Database, 2 * row - 1),)
+        data, items, inserts = self.post_tags(3)
+        self.assertEqual(len(inserts), 3)
+        self.assert_inserted(data, items)
+
+    def test_post_links_single_statement(self):
+        tags = [tag.id for tag in self.insert_tags(5)]
+        with QueryCounter(self.app.data.driver) as queries:
+            r = self.test_client.post('/notes',
+                                      data=json.dumps({'text': 'linked',
+                                                       'tags': tags}),
+                                      content_type='application/json')
+        response, status = self.parse_response(r)
+        self.assert201(status)
+        # the note and all of its links
+        inserts = [q for q in queries.queries if q.startswith('INSERT')]
+        self.assertEqual(len(inserts), 2)
+
+        stored, status = self.get('notes', item=response['id'])
+        self.assertEqual(stored['tags'], tags)
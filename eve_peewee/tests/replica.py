@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+from datetime import datetime
+
+import peewee
+
+from eve_peewee.tests import TestBaseSQL
+
+
+class TestReplicaSQL(TestBaseSQL):
+
+    def setUp(self):
+        super(TestReplicaSQL, self).setUp()
+        fd, self.replica_filename = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.app.config['DATABASE_REPLICA_URIS'] = [
+            'sqlite:///%s' % self.replica_filename]
+        data = self.app.data
+        data._setup_replicas(self.app.config)
+        self.replica = data.replicas[0]
+
+        tables = list(data.models.values()) + list(data.link_tables.values())
+        compiler = self.replica.compiler()
+        for model in peewee.sort_models_topologically(tables):
+            self.replica.execute_sql(*compiler.create_table(model, safe=True))
+        # a person only the replica has
+        now = datetime.utcnow()
+        sql, params = data.models[self.known_resource].insert(
+            firstname='replica', prog=0, _created=now, _updated=now).sql()
+        self.replica.execute_sql(sql, params)
+
+    def tearDown(self):
+        super(TestReplicaSQL, self).tearDown()
+        self.replica.close()
+        os.remove(self.replica_filename)
+
+    def firstnames(self):
+        response, status = self.get(self.known_resource)
+        self.assert200(status)
+        return [item['firstname'] for item in response['_items']]
+
+    def test_reads_from_replica(self):
+        self.assertEqual(self.firstnames(), ['replica'])
+
+    def tag_names(self):
+        response, status = self.get('tags')
+        self.assert200(status)
+        return [item['name'] for item in response['_items']]
+
+    def test_read_your_writes(self):
+        # tags, eve checks people's unique firstname the mongo way
+        r = self.test_client.post('/tags', data='{"name": "primary"}',
+                                  content_type='application/json')
+        self.assert201(r.status_code)
+        # the write went to the primary, which the client now reads from
+        self.assertEqual(self.tag_names(), ['primary'])
+        self.assertNotIn('replica', self.firstnames())
+
+        self.app.data._recent_writers.clear()
+        self.assertEqual(self.tag_names(), [])
+        self.assertEqual(self.firstnames(), ['replica'])
+
+    def test_least_load(self):
+        data = self.app.data
+        data.replicas = [self.replica, self.replica]
+        data.replica_strategy = 'least-load'
+        data._replica_load = [1, 0]
+        self.assertEqual(data._pick_replica(), 1)
+        self.assertEqual(data._pick_replica(), 0)
+        self.assertEqual(data._replica_load, [2, 1])
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from eve_peewee.schema import plan_indexes, provision_indexes
+
+from eve_peewee.tests import TestBaseSQL
+
+
+class TestSchemaSQL(TestBaseSQL):
+
+    def setUp(self):
+        super(TestSchemaSQL, self).setUp()
+        people = self.domain[self.known_resource]
+        people['allowed_filters'] = ['lastname', 'prog', '*']
+        people['datasource']['default_sort'] = [('prog', -1)]
+        self.people = {self.known_resource: people}
+
+    def index_names(self):
+        return set(ix.name for ix in
+                   self.app.data.driver.get_indexes(self.known_resource))
+
+    def test_plan_indexes(self):
+        specs = plan_indexes(self.app.data.models, self.people,
+                             self.app.data.driver)
+        self.assertEqual([spec.columns for spec in specs], [
+            [('prog', True), ('id', False)],
+            [('lastname', False), ('prog', True), ('id', False)],
+            [('prog', False), ('id', False)],
+        ])
+        # no partial indexes on sqlite
+        self.assertTrue(all(spec.where is None for spec in specs))
+
+    def test_plan_indexes_conditional_get(self):
+        specs = plan_indexes(self.app.data.models, self.people,
+                             self.app.data.driver, conditional_get=True)
+        self.assertEqual(specs[-1].columns, [('_updated', False)])
+
+    def test_provision_indexes(self):
+        db = self.app.data.driver
+        statements = provision_indexes(self.app.data.models, self.people, db,
+                                       dry_run=True)
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(statements[0].startswith('CREATE INDEX'))
+        self.assertFalse(any(name.startswith('ix_') for name in self.index_names()))
+
+        provision_indexes(self.app.data.models, self.people, db)
+        self.assertEqual(len([name for name in self.index_names()
+                              if name.startswith('ix_')]), 3)
+        # nothing left to do
+        self.assertEqual(provision_indexes(self.app.data.models, self.people, db), [])
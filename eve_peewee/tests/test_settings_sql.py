@@ -10,9 +10,13 @@ RESOURCE_METHODS = ['GET', 'POST', 'DELETE']
 ITEM_METHODS = ['GET', 'PATCH', 'DELETE', 'PUT']
 
 ID_FIELD = 'id'
+ITEM_LOOKUP_FIELD = 'id'
+ITEM_URL = 'regex("[0-9]+")'
 
 VALIDATE_FILTERS = True
 
+PEEWEE_BATCH_URL = 'batch'
+
 people = {'item_title': 'person',
 #          'additional_lookup': {
 #              'url': 'regex("[\w]+")',
@@ -21,6 +25,7 @@ people = {'item_title': 'person',
           'cache_control': 'max-age=10,must-revalidate',
           'cache_expires': 10,
           'resource_methods': ['GET', 'POST', 'DELETE'],
+          '_peewee': {'export': True},
           'schema': {
               #'invoices_collection': {
               #    'type': 'integer',
@@ -63,11 +68,37 @@ payments = {
     'schema': {}
 }
 
+tags = {
+    'schema': {
+        'name': {'type': 'string'},
+    }
+}
+
+notes = {
+    'schema': {
+        'text': {'type': 'string'},
+        # stored as JSON
+        'extra': {'type': 'dict'},
+        # 1:m
+        'person': {
+            'type': 'integer',
+            'data_relation': {'resource': 'people', 'embeddable': True}},
+        # m:m
+        'tags': {
+            'type': 'list',
+            'schema': {
+                'type': 'integer',
+                'data_relation': {'resource': 'tags', 'embeddable': True}}},
+    }
+}
+
 DOMAIN = {
     'people': people,
     'users': users,
     'users_overseas': users_overseas,
 #    'invoices': invoices,
     'userinvoices': user_invoices,
-    'payments': payments
+    'payments': payments,
+    'tags': tags,
+    'notes': notes,
 }
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import json
+
+from eve.utils import ParsedRequest
+
+from eve_peewee.tests import TestBaseSQL
+
+
+class TestWhereSQL(TestBaseSQL):
+
+    def progs(self, where):
+        r = self.test_client.get('%s?where=%s&max_results=200' % (
+            self.known_resource_url, json.dumps(where)))
+        response, status = self.parse_response(r)
+        self.assert200(status)
+        return sorted(item['prog'] for item in response['_items'])
+
+    def assert_where_400(self, where):
+        r = self.test_client.get('%s?where=%s' % (self.known_resource_url,
+                                                  json.dumps(where)))
+        self.assert400(r.status_code)
+
+    def test_or(self):
+        self.assertEqual(self.progs({'$or': [{'prog': 1}, {'prog': 2}]}),
+                         [1, 2])
+        self.assertEqual(self.progs({'$or': [{'prog': {'$lt': 2}},
+                                             {'prog': {'$gt': 98}}]}),
+                         [0, 1, 99, 100])
+
+    def test_or_in_list(self):
+        model = self.app.data.models[self.known_resource]
+        with self.app.test_request_context():
+            expr = self.app.data._where_expression(
+                model, {'$or': [{'prog': 1}, {'prog': {'$in': [2, 3]}}]})
+        sql, params = model.select().where(expr).sql()
+        self.assertIn(' IN ', sql)
+        self.assertNotIn(' OR ', sql)
+        self.assertEqual(params, [1, 2, 3])
+
+    def test_and_nor_operators(self):
+        self.assertEqual(self.progs({
+            'prog': {'$gte': 10, '$lt': 20},
+            '$nor': [{'prog': {'$in': [11, 12]}}, {'prog': 19}]}),
+            [10, 13, 14, 15, 16, 17, 18])
+        self.assertEqual(self.progs({'$and': [{'prog__lt': 5},
+                                              {'prog': {'$nin': [0, 1]}}]}),
+                         [2, 3, 4])
+
+    def test_plan_cache(self):
+        self.progs({'prog': {'$in': [1, 2]}})
+        misses = self.app.data.query_plan_stats()['misses']
+        self.assertEqual(self.progs({'prog': {'$in': [3]}}), [3])
+        self.assertEqual(self.app.data.query_plan_stats()['misses'], misses)
+        # same key, different shape
+        self.assertEqual(self.progs({'prog': 4}), [4])
+
+    def test_lookup_not_overridden(self):
+        req = ParsedRequest()
+        req.where = json.dumps({'prog': 4})
+        with self.app.test_request_context():
+            docs = list(self.app.data._find(self.known_resource, req,
+                                            lookup={'prog': 3}).dicts())
+        self.assertEqual(docs, [])
+
+        req.where = json.dumps({'$or': [{'prog': 3}, {'prog': 4}]})
+        with self.app.test_request_context():
+            docs = list(self.app.data._find(self.known_resource, req,
+                                            lookup={'prog': 3}).dicts())
+        self.assertEqual([d['prog'] for d in docs], [3])
+
+    def test_invalid(self):
+        self.assert_where_400({'$where': 'true'})
+        self.assert_where_400({'$or': {'prog': 1}})
+        self.assert_where_400({'prog': {'$regex': '1'}})
+        self.assert_where_400({'prog': {'$in': 1}})
+        self.assert_where_400({'$or': [{'nope': 1}, {'prog': 2}]})
+
+    def test_limits(self):
+        where = {'prog': 1}
+        for _ in range(self.app.data.max_where_depth):
+            where = {'$or': [where]}
+        self.assert_where_400(where)
+        self.assert_where_400(
+            {'prog': {'$in': list(range(self.app.data.max_where_size + 1))}})
+
+    def test_allowed_filters(self):
+        self.app.config['DOMAIN'][self.known_resource]['allowed_filters'] = \
+            ['prog']
+        self.assertEqual(self.progs({'$or': [{'prog': 1}, {'prog': 2}]}),
+                         [1, 2])
+        self.assert_where_400({'$or': [{'prog': 1}, {'firstname': 'x'}]})
+        self.assert_where_400({'prog': {'$in': [1, 'x']}})